@@ -0,0 +1,229 @@
+"""
+Kontrola przyjmowania żądań i zrzucanie obciążenia według priorytetu.
+
+Każdy endpoint należy do klasy priorytetu (ADMISSION_ROUTE_PRIORITIES,
+domyślnie 'normal'):
+  - 'critical' - logowanie, rejestracja, pushe aktywności, health, /metrics,
+  - 'normal'   - pozostałe,
+  - 'low'      - drogie odczyty: nearby-listeners, users/search, trending, friends/activity.
+
+Proces obsługuje naraz co najwyżej ADMISSION_MAX_CONCURRENCY żądań. Klasa
+może zająć slot tylko wtedy, gdy zajętych jest mniej niż jej udział w limicie
+(ADMISSION_PRIORITY_SHARES), więc przy nasyceniu ostatnie wolne sloty
+zostają dla pushy i autoryzacji. Żądanie bez slotu czeka w ograniczonej
+kolejce swojej klasy (ADMISSION_QUEUE_LIMITS) najwyżej ADMISSION_QUEUE_TIMEOUTS
+sekund; zwolniony slot dostaje najstarsze czekające żądanie najwyższej klasy.
+
+Żądanie odrzucone (pełna kolejka lub koniec czasu oczekiwania):
+  - dla endpointów z ADMISSION_STALE_ENDPOINTS dostaje ostatnią udaną odpowiedź
+    dla tego samego użytkownika i zapytania, jeśli nie jest starsza niż
+    ADMISSION_STALE_MAX_AGE (nagłówki Age i X-HearNear-Degraded: stale);
+    użytkownika ustala funkcja identify przekazana do init_app (ważny, nieprzeterminowany
+    token) - bez niej lub przy złym tokenie stara odpowiedź nie jest wydawana,
+  - w przeciwnym razie 503 z Retry-After.
+
+Pamięć starych odpowiedzi jest ograniczona liczbą wpisów i sumą bajtów
+(ADMISSION_STALE_CACHE_BYTES); ciała większe niż ADMISSION_STALE_MAX_BODY
+nie są zapamiętywane.
+
+Limit jest per proces - ma sens, gdy serwer WSGI przyjmuje więcej żądań
+naraz niż ADMISSION_MAX_CONCURRENCY (np. gunicorn --threads). 0 wyłącza kontrolę.
+"""
+import collections
+import threading
+import time
+
+from flask import current_app, g, jsonify, request
+
+from lrucache import LRUCache
+from metrics import Counter, Gauge, Histogram
+
+PRIORITIES = ('critical', 'normal', 'low')
+QUEUE_TIME_BUCKETS = (0.0, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+DEFAULTS = {
+    'ADMISSION_MAX_CONCURRENCY': 0,
+    'ADMISSION_PRIORITY_SHARES': {'critical': 1.0, 'normal': 0.85, 'low': 0.6},
+    'ADMISSION_QUEUE_LIMITS': {'critical': 128, 'normal': 32, 'low': 8},
+    'ADMISSION_QUEUE_TIMEOUTS': {'critical': 5.0, 'normal': 1.0, 'low': 0.25},
+    'ADMISSION_ROUTE_PRIORITIES': {
+        'api.register': 'critical',
+        'api.login': 'critical',
+        'api.verify_token': 'critical',
+        'api.logout': 'critical',
+        'api.update_activity': 'critical',
+        'api.delete_activity': 'critical',
+        'api.health': 'critical',
+        'metrics': 'critical',
+        'api.get_nearby_listeners': 'low',
+        'api.search_users': 'low',
+        'api.get_trending_nearby': 'low',
+        'api.get_friends_activity': 'low',
+    },
+    'ADMISSION_STALE_ENDPOINTS': {'api.get_nearby_listeners', 'api.get_trending_nearby'},
+    'ADMISSION_STALE_MAX_AGE': 120,
+    'ADMISSION_STALE_CACHE_ENTRIES': 2048,
+    'ADMISSION_STALE_CACHE_BYTES': 32 * 1024 * 1024,
+    'ADMISSION_STALE_MAX_BODY': 256 * 1024,
+    'ADMISSION_RETRY_AFTER': 2,
+}
+
+
+class ConcurrencyLimiter:
+    """Semafor z priorytetami: sloty i ograniczone kolejki FIFO per klasa."""
+
+    def __init__(self, max_concurrency, shares, queue_limits, on_queue_change=None):
+        self.max_concurrency = max_concurrency
+        self.class_limits = {p: max(1, int(max_concurrency * shares[p])) for p in PRIORITIES}
+        self.queue_limits = queue_limits
+        self.in_flight = 0
+        self._queues = {p: collections.deque() for p in PRIORITIES}
+        self._lock = threading.Lock()
+        self._on_queue_change = on_queue_change
+
+    def _can_run(self, priority):
+        return self.in_flight < self.class_limits[priority]
+
+    def _queue_changed(self, priority):
+        if self._on_queue_change is not None:
+            self._on_queue_change(priority, len(self._queues[priority]))
+
+    def acquire(self, priority, timeout):
+        """Zwraca True, gdy przydzielono slot (od razu albo po czekaniu w kolejce)."""
+        with self._lock:
+            ahead = any(self._queues[p] for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+            if not ahead and self._can_run(priority):
+                self.in_flight += 1
+                return True
+            waiting = self._queues[priority]
+            if len(waiting) >= self.queue_limits[priority]:
+                return False
+            granted = threading.Event()
+            waiting.append(granted)
+            self._queue_changed(priority)
+        if granted.wait(timeout):
+            return True
+        with self._lock:
+            if granted.is_set():  # slot przydzielony tuż po upływie czasu
+                return True
+            waiting.remove(granted)
+            self._queue_changed(priority)
+            return False
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            for priority in PRIORITIES:
+                waiting = self._queues[priority]
+                if waiting and self._can_run(priority):
+                    self.in_flight += 1
+                    waiting.popleft().set()
+                    self._queue_changed(priority)
+                    break
+
+
+class AdmissionControl:
+    def __init__(self, app=None, metrics=None, identify=None):
+        self.metrics = metrics
+        self.identify = identify
+        self.limiter = None
+        self.stale = None
+        self.queue_time = None
+        self.requests = None
+        self.queue_depth = None
+        if app is not None:
+            self.init_app(app, metrics, identify)
+
+    def init_app(self, app, metrics=None, identify=None):
+        """identify() -> id użytkownika z ważnego tokenu bieżącego żądania albo None."""
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        config = app.config
+        if identify is not None:
+            self.identify = identify
+        if metrics is not None:
+            self.metrics = metrics
+            r = metrics.registry.register
+            self.queue_time = r(Histogram(
+                'hearnear_admission_queue_seconds', 'Time requests waited for a concurrency slot.',
+                ('priority',), buckets=QUEUE_TIME_BUCKETS))
+            self.requests = r(Counter(
+                'hearnear_admission_requests_total', 'Requests by priority class and admission outcome.',
+                ('priority', 'result')))
+            self.queue_depth = r(Gauge(
+                'hearnear_admission_queue_depth', 'Requests waiting for a concurrency slot.',
+                ('priority',)))
+            in_flight = r(Gauge(
+                'hearnear_admission_in_flight', 'Requests holding a concurrency slot.'))
+            in_flight.set_function(lambda: self.limiter.in_flight if self.limiter is not None else 0)
+        if not config['ADMISSION_MAX_CONCURRENCY']:
+            return
+        self.limiter = ConcurrencyLimiter(
+            config['ADMISSION_MAX_CONCURRENCY'], config['ADMISSION_PRIORITY_SHARES'],
+            config['ADMISSION_QUEUE_LIMITS'], self._set_queue_depth)
+        self.stale = LRUCache(config['ADMISSION_STALE_CACHE_ENTRIES'], config['ADMISSION_STALE_CACHE_BYTES'])
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.extensions['hearnear_admission'] = self
+
+    def _set_queue_depth(self, priority, depth):
+        if self.queue_depth is not None:
+            self.queue_depth.set(depth, priority=priority)
+
+    def _count(self, priority, result):
+        if self.requests is not None:
+            self.requests.inc(priority=priority, result=result)
+
+    def _stale_key(self):
+        """Klucz (użytkownik, zapytanie) albo None, gdy token jest nieważny lub przeterminowany."""
+        user_id = self.identify() if self.identify is not None else None
+        if user_id is None:
+            return None
+        return user_id, request.full_path
+
+    def _before_request(self):
+        config = current_app.config
+        endpoint = request.endpoint
+        priority = config['ADMISSION_ROUTE_PRIORITIES'].get(endpoint, 'normal')
+        start = time.perf_counter()
+        admitted = self.limiter.acquire(priority, config['ADMISSION_QUEUE_TIMEOUTS'][priority])
+        if self.queue_time is not None:
+            self.queue_time.observe(time.perf_counter() - start, priority=priority)
+        if admitted:
+            g.admission_slot = True
+            self._count(priority, 'admitted')
+            return None
+
+        key = self._stale_key() if endpoint in config['ADMISSION_STALE_ENDPOINTS'] else None
+        if key is not None:
+            cached = self.stale.get(key)
+            if cached is not None:
+                stored_at, body, mimetype = cached
+                age = time.time() - stored_at
+                if age <= config['ADMISSION_STALE_MAX_AGE']:
+                    self._count(priority, 'stale')
+                    response = current_app.response_class(body, mimetype=mimetype)
+                    response.headers['Age'] = str(int(age))
+                    response.headers['X-HearNear-Degraded'] = 'stale'
+                    return response
+        self._count(priority, 'rejected')
+        response = jsonify({'error': 'Server is overloaded, retry later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(config['ADMISSION_RETRY_AFTER'])
+        return response
+
+    def _after_request(self, response):
+        # hook zarejestrowany po kompresji, więc widzi jeszcze nieskompresowane ciało
+        config = current_app.config
+        if (g.get('admission_slot') and response.status_code == 200
+                and request.endpoint in config['ADMISSION_STALE_ENDPOINTS']):
+            body = response.get_data()
+            key = self._stale_key() if len(body) <= config['ADMISSION_STALE_MAX_BODY'] else None
+            if key is not None:
+                self.stale.put(key, (time.time(), body, response.mimetype), len(body))
+        return response
+
+    def _teardown_request(self, exc):
+        if g.pop('admission_slot', False):
+            self.limiter.release()
@@ -0,0 +1,82 @@
+"""
+Wysyłanie plików avatarów bez kopiowania bajtów przez workera Pythona.
+
+Tryby (AVATAR_DELIVERY):
+  - 'python'     - send_from_directory (domyślny, jak dotychczas),
+  - 'sendfile'   - plik przekazany serwerowi WSGI przez wsgi.file_wrapper
+                   (gunicorn wysyła go wtedy przez os.sendfile),
+  - 'x-accel'    - pusta odpowiedź z X-Accel-Redirect; plik wysyła nginx
+                   z lokalizacji `internal` pod AVATAR_ACCEL_PREFIX,
+  - 'x-sendfile' - pusta odpowiedź z X-Sendfile (Apache mod_xsendfile, lighttpd).
+
+We wszystkich trybach ETag i Last-Modified wyliczane są z os.stat, a żądania
+warunkowe (If-None-Match / If-Modified-Since) dostają 304 bez otwierania pliku.
+Nazwy avatarów zawierają znacznik czasu uploadu, więc treść pod danym URL
+nigdy się nie zmienia i można ją cache'ować długo.
+"""
+import datetime
+import mimetypes
+import os
+
+from flask import abort, current_app, request, send_from_directory
+from werkzeug.http import is_resource_modified
+from werkzeug.utils import safe_join
+from werkzeug.wsgi import wrap_file
+
+DELIVERY_MODES = ('python', 'sendfile', 'x-accel', 'x-sendfile')
+
+DEFAULTS = {
+    'AVATAR_DELIVERY': 'python',
+    'AVATAR_ACCEL_PREFIX': '/_protected_avatars/',
+    'AVATAR_MAX_AGE': 365 * 24 * 3600,
+}
+
+
+def _etag(st):
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}'
+
+
+def avatar_response(filename):
+    config = current_app.config
+    folder = config['UPLOAD_FOLDER']
+    mode = config.get('AVATAR_DELIVERY', DEFAULTS['AVATAR_DELIVERY'])
+    if mode not in DELIVERY_MODES:
+        raise ValueError(f'Unknown AVATAR_DELIVERY mode: {mode}')
+    max_age = config.get('AVATAR_MAX_AGE', DEFAULTS['AVATAR_MAX_AGE'])
+
+    path = safe_join(folder, filename)
+    if path is None:
+        abort(404)
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        abort(404)
+    etag = _etag(st)
+    last_modified = datetime.datetime.fromtimestamp(st.st_mtime, tz=datetime.timezone.utc)
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = current_app.response_class(status=304)
+    elif mode == 'python':
+        response = send_from_directory(folder, filename, etag=etag, max_age=max_age)
+    else:
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if mode == 'sendfile':
+            response = current_app.response_class(
+                wrap_file(request.environ, open(path, 'rb')), mimetype=mimetype, direct_passthrough=True)
+            response.content_length = st.st_size
+        else:
+            response = current_app.response_class(mimetype=mimetype)
+            if mode == 'x-accel':
+                prefix = config.get('AVATAR_ACCEL_PREFIX', DEFAULTS['AVATAR_ACCEL_PREFIX'])
+                response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + filename
+            else:
+                response.headers['X-Sendfile'] = os.path.abspath(path)
+            # długość ustawi proxy po podmianie treści
+            response.headers.pop('Content-Length', None)
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,86 @@
+"""
+Benchmark wysyłania avatarów w różnych trybach AVATAR_DELIVERY.
+
+Dla każdego trybu mierzy czas CPU workera na żądanie (pełne pobranie
+i żądanie warunkowe z If-None-Match) oraz liczbę bajtów, które przeszły
+przez Pythona. Serwer WSGI jest symulowany: w trybie 'sendfile'
+wsgi.file_wrapper tylko zapamiętuje plik - tak jak gunicorn, który
+przekazuje go dalej do os.sendfile.
+
+    python bench_avatars.py [liczba_żądań]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from python_auth_server import create_app
+
+AVATAR_BYTES = 60 * 1024
+AVATARS = 40
+
+
+class _SendfileWrapper:
+    """Zachowanie gunicorna: plik nie jest czytany w Pythonie."""
+
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+
+    def __iter__(self):
+        return iter(())
+
+    def close(self):
+        self.filelike.close()
+
+
+def _request(app, path, headers, file_wrapper):
+    environ_base = {'wsgi.file_wrapper': file_wrapper} if file_wrapper else {}
+    with app.test_request_context(path, headers=headers, environ_base=environ_base):
+        response = app.full_dispatch_request()
+        body = sum(len(chunk) for chunk in response.response)
+        response.close()
+        return response, body
+
+
+def bench(mode, folder, names, requests):
+    app = create_app({'AVATAR_DELIVERY': mode, 'UPLOAD_FOLDER': folder, 'TESTING': True})
+    file_wrapper = _SendfileWrapper if mode == 'sendfile' else None
+    python_bytes = 0
+    etags = {}
+    start = time.process_time()
+    for i in range(requests):
+        name = names[i % len(names)]
+        response, body = _request(app, f'/avatars/{name}', {}, file_wrapper)
+        python_bytes += body
+        etags[name] = response.headers['ETag']
+    full = (time.process_time() - start) / requests
+
+    start = time.process_time()
+    for i in range(requests):
+        name = names[i % len(names)]
+        response, _ = _request(app, f'/avatars/{name}', {'If-None-Match': etags[name]}, file_wrapper)
+        assert response.status_code == 304
+    conditional = (time.process_time() - start) / requests
+    print(f'{mode:<11} full {full * 1e6:8.1f} us/req   304 {conditional * 1e6:8.1f} us/req   '
+          f'bytes through Python {python_bytes / requests / 1024:6.1f} KiB/req')
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    folder = tempfile.mkdtemp(prefix='hearnear-avatars-')
+    try:
+        names = []
+        for i in range(AVATARS):
+            name = f'user_{i}_1700000000.webp'
+            with open(os.path.join(folder, name), 'wb') as fh:
+                fh.write(os.urandom(AVATAR_BYTES))
+            names.append(name)
+        for mode in ('python', 'sendfile', 'x-accel', 'x-sendfile'):
+            bench(mode, folder, names, requests)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
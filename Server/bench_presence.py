@@ -0,0 +1,73 @@
+"""
+Benchmark / test dymny partycjonowania obecności (presence.py).
+
+Generuje losowych słuchaczy w kilku skupiskach, porównuje wyniki routera
+z pełnym przeglądem i mierzy czas zapytań dla partycji w procesie
+oraz w osobnych procesach.
+
+    python bench_presence.py [liczba_użytkowników] [liczba_partycji]
+"""
+import random
+import sys
+import time
+
+from geo import calculate_distance
+from presence import InProcessBus, PresenceRouter, ProcessPartitionBus, start_local_partitions
+
+CITIES = [(52.23, 21.01), (50.06, 19.94), (51.11, 17.03), (54.35, 18.65), (48.86, 2.35), (40.71, -74.0)]
+QUERIES = 300
+RADIUS_KM = 50
+
+
+def generate_users(count):
+    users = []
+    for user_id in range(count):
+        lat, lon = random.choice(CITIES)
+        users.append((user_id, lat + random.gauss(0, 0.3), lon + random.gauss(0, 0.3)))
+    return users
+
+
+def brute_force(users, latitude, longitude, radius_km):
+    return sorted(uid for uid, lat, lon in users if calculate_distance(latitude, longitude, lat, lon) <= radius_km)
+
+
+def run(name, router, users, queries):
+    start = time.perf_counter()
+    for user_id, lat, lon in users:
+        router.update(user_id, lat, lon, 1.0)
+    router.sizes()  # bariera - wszystkie aktualizacje przetworzone
+    load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    answers = [sorted(uid for _, uid, _ in router.nearby(lat, lon, RADIUS_KM, 0.0)) for lat, lon in queries]
+    elapsed = time.perf_counter() - start
+    print(f'{name:<22} load {load:6.2f}s  query {elapsed / len(queries) * 1000:7.2f} ms/q  '
+          f'partition sizes {router.sizes()}')
+    return answers
+
+
+def main():
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    partition_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    random.seed(1)
+    users = generate_users(user_count)
+    queries = [(lat + random.gauss(0, 0.3), lon + random.gauss(0, 0.3)) for lat, lon in random.choices(CITIES, k=QUERIES)]
+
+    start = time.perf_counter()
+    expected = [brute_force(users, lat, lon, RADIUS_KM) for lat, lon in queries]
+    print(f'{"full scan":<22} query {(time.perf_counter() - start) / QUERIES * 1000:7.2f} ms/q')
+
+    bus = InProcessBus()
+    start_local_partitions(bus, partition_count)
+    assert run('in-process partitions', PresenceRouter(bus, partition_count), users, queries) == expected
+
+    bus = ProcessPartitionBus(range(partition_count), timeout=30.0)
+    try:
+        assert run('process partitions', PresenceRouter(bus, partition_count), users, queries) == expected
+    finally:
+        bus.close()
+    print('results match full scan')
+
+
+if __name__ == '__main__':
+    main()
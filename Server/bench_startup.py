@@ -0,0 +1,60 @@
+"""
+Benchmark zimnego startu workera.
+
+Mierzy w świeżych procesach Pythona czas:
+  - importu modułu serwera,
+  - create_app(),
+  - pierwszego żądania (/api/health),
+oraz czas importu modułów ładowanych leniwie (PIL), których worker nie płaci na starcie.
+
+    python bench_startup.py [liczba_powtórzeń]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PROBE = r'''
+import json, sys, time
+t0 = time.perf_counter()
+import python_auth_server
+t1 = time.perf_counter()
+app = python_auth_server.create_app()
+t2 = time.perf_counter()
+app.test_client().get('/api/health')
+t3 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'create_app': t2 - t1, 'first_request': t3 - t2,
+                  'pil_loaded': 'PIL.Image' in sys.modules}))
+'''
+
+LAZY_PROBE = r'''
+import json, time
+t0 = time.perf_counter()
+from PIL import Image
+print(json.dumps({'PIL.Image': time.perf_counter() - t0}))
+'''
+
+
+def _run(code):
+    out = subprocess.run([sys.executable, '-c', code], cwd=HERE, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    samples = [_run(PROBE) for _ in range(runs)]
+    for key in ('import', 'create_app', 'first_request'):
+        values = [s[key] * 1000 for s in samples]
+        print(f'{key:<14} median {statistics.median(values):7.1f} ms   min {min(values):7.1f} ms')
+    total = [sum(s[k] for k in ('import', 'create_app', 'first_request')) * 1000 for s in samples]
+    print(f'{"total":<14} median {statistics.median(total):7.1f} ms')
+    print(f'PIL loaded at startup: {any(s["pil_loaded"] for s in samples)}')
+    lazy = statistics.median(_run(LAZY_PROBE)['PIL.Image'] for _ in range(runs)) * 1000
+    print(f'deferred to first avatar upload: PIL.Image {lazy:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
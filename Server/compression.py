@@ -0,0 +1,137 @@
+"""
+Kompresja odpowiedzi negocjowana przez Accept-Encoding.
+
+Obsługiwane kodowania (w kolejności preferencji serwera): br, zstd, gzip.
+br i zstd są opcjonalne - działają tylko, gdy zainstalowano pakiety
+`brotli` / `zstandard`; gzip jest zawsze dostępny.
+
+Skompresowane ciała trafiają do pamięci podręcznej LRU kluczowanej skrótem
+treści, więc powtarzające się odpowiedzi (np. niezmieniony zestaw słuchaczy,
+agregaty trending) kompresowane są tylko raz.
+"""
+import gzip
+import hashlib
+from collections import OrderedDict
+
+from flask import current_app, request
+
+from lrucache import LRUCache
+
+try:
+    import brotli
+except ImportError:  # opcjonalna zależność
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # opcjonalna zależność
+    zstandard = None
+
+DEFAULTS = {
+    'COMPRESSION_ENABLED': True,
+    'COMPRESSION_MIN_SIZE': 1024,
+    'COMPRESSION_LEVELS': {'br': 5, 'zstd': 3, 'gzip': 6},
+    'COMPRESSION_MIMETYPES': {'application/json', 'text/plain', 'text/html'},
+    'COMPRESSION_CACHE_ENTRIES': 256,
+    'COMPRESSION_CACHE_MAX_BODY': 512 * 1024,
+}
+
+
+def _compress_br(data, level):
+    return brotli.compress(data, quality=level)
+
+
+def _compress_zstd(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _compress_gzip(data, level):
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+COMPRESSORS = OrderedDict()
+if brotli is not None:
+    COMPRESSORS['br'] = _compress_br
+if zstandard is not None:
+    COMPRESSORS['zstd'] = _compress_zstd
+COMPRESSORS['gzip'] = _compress_gzip
+
+
+def negotiate_encoding(accept_encoding, available=COMPRESSORS):
+    """Wybiera kodowanie z najwyższym q; przy remisie decyduje kolejność w available."""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name] = q
+    best, best_q = None, 0.0
+    for encoding in available:
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class Compression:
+    def __init__(self, app=None, metrics=None):
+        self.metrics = metrics
+        self.cache = None
+        if app is not None:
+            self.init_app(app, metrics)
+
+    def init_app(self, app, metrics=None):
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        if metrics is not None:
+            self.metrics = metrics
+        self.cache = LRUCache(app.config['COMPRESSION_CACHE_ENTRIES'])
+        app.after_request(self._after_request)
+        app.extensions['hearnear_compression'] = self
+
+    def compress(self, data, encoding):
+        """Zwraca skompresowane data, korzystając z pamięci podręcznej."""
+        config = current_app.config
+        level = config['COMPRESSION_LEVELS'].get(encoding)
+        cacheable = len(data) <= config['COMPRESSION_CACHE_MAX_BODY']
+        if cacheable:
+            key = (encoding, level, hashlib.blake2b(data, digest_size=16).digest())
+            cached = self.cache.get(key)
+            if cached is not None:
+                if self.metrics is not None:
+                    self.metrics.cache_hit('compressed_body')
+                return cached
+            if self.metrics is not None:
+                self.metrics.cache_miss('compressed_body')
+        compressed = COMPRESSORS[encoding](data, level)
+        if cacheable:
+            self.cache.put(key, compressed)
+        return compressed
+
+    def _after_request(self, response):
+        config = current_app.config
+        if not config['COMPRESSION_ENABLED']:
+            return response
+        if (response.direct_passthrough or response.is_streamed
+                or response.status_code < 200 or response.status_code in (204, 304)
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in config['COMPRESSION_MIMETYPES']):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return response
+        data = response.get_data()
+        if len(data) < config['COMPRESSION_MIN_SIZE']:
+            return response
+        response.set_data(self.compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
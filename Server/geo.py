@@ -0,0 +1,28 @@
+"""
+Wspólne funkcje geograficzne (bez zależności od Flask - używane też w procesach partycji).
+"""
+import math
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = 111.32
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    R = EARTH_RADIUS_KM
+    lat1_rad = math.radians(lat1)
+    lon1_rad = math.radians(lon1)
+    lat2_rad = math.radians(lat2)
+    lon2_rad = math.radians(lon2)
+    dlat = lat2_rad - lat1_rad
+    dlon = lon2_rad - lon1_rad
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return R * c
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """Zwraca (min_lat, max_lat, min_lon, max_lon) obejmujące okrąg o promieniu radius_km."""
+    lat_delta = radius_km / KM_PER_DEGREE
+    cos_lat = max(math.cos(math.radians(latitude)), 0.01)
+    lon_delta = min(radius_km / (KM_PER_DEGREE * cos_lat), 180.0)
+    return latitude - lat_delta, latitude + lat_delta, longitude - lon_delta, longitude + lon_delta
@@ -0,0 +1,342 @@
+"""
+Historia słuchania w plikach segmentów tylko-do-dopisywania (poza bazą SQLite).
+
+Każdy zapisany push aktywności trafia jako rekord (user_id, track_id,
+szerokość, długość, znacznik czasu) do kolejki w pamięci; wątek w tle zbiera
+rekordy w bloki, kompresuje je zlib i dopisuje do bieżącego segmentu w
+HISTORY_DIR. Segment jest zamykany (fsync) i zastępowany nowym po
+przekroczeniu HISTORY_SEGMENT_MAX_BYTES lub HISTORY_SEGMENT_MAX_SECONDS.
+Przy otwarciu każdego segmentu wątek usuwa segmenty, do których nikt nie
+pisał dłużej niż HISTORY_RETENTION_SECONDS (0 = bez limitu).
+Żądanie HTTP tylko wkłada rekord do kolejki; gdy kolejka jest pełna, rekord
+jest odrzucany i liczony w hearnear_history_records_total{result="dropped"}.
+
+Format segmentu (little-endian):
+    nagłówek pliku  FILE_MAGIC (8 bajtów)
+    blok            BLOCK_HEADER: długość danych, liczba rekordów, crc32 danych,
+                    najmniejszy i największy znacznik czasu (ms od epoki, UTC)
+                    + dane: zlib(RECORD * liczba rekordów)
+    RECORD          user_id, track_id, lat * 1e7, lon * 1e7, znacznik czasu w ms
+
+Nazwa segmentu zawiera czas otwarcia i pid procesu, więc każdy worker pisze
+do własnych plików. Odczyt (SegmentReader, iter_history) mapuje segment do
+pamięci, pomija bloki spoza zakresu czasu po samych nagłówkach i kończy
+segment na pierwszym niepełnym bloku - można więc czytać także segment,
+do którego serwer właśnie dopisuje.
+
+Eksport do CSV: `python history_log.py instance/history --since 1700000000`.
+"""
+import atexit
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+FILE_MAGIC = b'HNHL\x01\x00\x00\x00'
+BLOCK_HEADER = struct.Struct('<IIIqq')
+RECORD = struct.Struct('<IIiiq')
+SEGMENT_SUFFIX = '.hlog'
+COORD_SCALE = 10 ** 7
+
+DEFAULTS = {
+    'HISTORY_ENABLED': False,
+    'HISTORY_DIR': None,  # domyślnie <instance>/history
+    'HISTORY_SEGMENT_MAX_BYTES': 64 * 1024 * 1024,
+    'HISTORY_SEGMENT_MAX_SECONDS': 3600,
+    'HISTORY_RETENTION_SECONDS': 30 * 24 * 3600,
+    'HISTORY_BLOCK_RECORDS': 4096,
+    'HISTORY_FLUSH_SECONDS': 5.0,
+    'HISTORY_QUEUE_SIZE': 100000,
+    'HISTORY_COMPRESSION_LEVEL': 6,
+}
+
+HistoryRecord = namedtuple('HistoryRecord', 'user_id track_id latitude longitude timestamp')
+
+
+def _to_ms(timestamp):
+    return int(round(timestamp * 1000))
+
+
+# --- ZAPIS ---
+class SegmentWriter:
+    """Dopisuje skompresowane bloki rekordów do rotowanych plików segmentów."""
+
+    def __init__(self, directory, max_bytes, max_seconds, compression_level=6, retention_seconds=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compression_level = compression_level
+        self.retention_seconds = retention_seconds
+        self._file = None
+        self._opened_at = 0.0
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._opened_at = time.time()
+        if self.retention_seconds:
+            self.remove_expired(self._opened_at - self.retention_seconds)
+        name = f'history-{_to_ms(self._opened_at):013d}-{os.getpid()}{SEGMENT_SUFFIX}'
+        self._file = open(os.path.join(self.directory, name), 'ab')
+        if self._file.tell() == 0:
+            self._file.write(FILE_MAGIC)
+
+    def _should_rotate(self):
+        return (self._file.tell() >= self.max_bytes
+                or time.time() - self._opened_at >= self.max_seconds)
+
+    def remove_expired(self, cutoff):
+        """Usuwa segmenty (także innych workerów) ostatnio modyfikowane przed cutoff; zwraca ich liczbę."""
+        removed = 0
+        for path in segment_paths(self.directory):
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:  # usunięty równolegle przez inny worker
+                continue
+        return removed
+
+    def write_block(self, records):
+        """records: lista krotek (user_id, track_id, lat, lon, ts_sekundy)."""
+        if not records:
+            return
+        if self._file is not None and self._should_rotate():
+            self.close()
+        if self._file is None:
+            self._open_segment()
+        packed = bytearray(RECORD.size * len(records))
+        timestamps = []
+        for i, (user_id, track_id, latitude, longitude, ts) in enumerate(records):
+            ts_ms = _to_ms(ts)
+            timestamps.append(ts_ms)
+            RECORD.pack_into(packed, i * RECORD.size, user_id, track_id,
+                             round(latitude * COORD_SCALE), round(longitude * COORD_SCALE), ts_ms)
+        data = zlib.compress(bytes(packed), self.compression_level)
+        header = BLOCK_HEADER.pack(len(data), len(records), zlib.crc32(data), min(timestamps), max(timestamps))
+        self._file.write(header + data)
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+
+class HistoryLog:
+    """Rozszerzenie Flask: kolejka rekordów historii + wątek piszący segmenty."""
+
+    def __init__(self, app=None, metrics=None):
+        self.metrics = metrics
+        self.records = None
+        self.enabled = False
+        self._settings = None
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, metrics)
+
+    def init_app(self, app, metrics=None):
+        from metrics import Counter  # metrics wymaga Flask; czytnik segmentów ma działać bez niego
+
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        config = app.config
+        self.enabled = config['HISTORY_ENABLED']
+        self._settings = {
+            'directory': config['HISTORY_DIR'] or os.path.join(app.instance_path, 'history'),
+            'max_bytes': config['HISTORY_SEGMENT_MAX_BYTES'],
+            'max_seconds': config['HISTORY_SEGMENT_MAX_SECONDS'],
+            'block_records': config['HISTORY_BLOCK_RECORDS'],
+            'flush_seconds': config['HISTORY_FLUSH_SECONDS'],
+            'queue_size': config['HISTORY_QUEUE_SIZE'],
+            'compression_level': config['HISTORY_COMPRESSION_LEVEL'],
+            'retention_seconds': config['HISTORY_RETENTION_SECONDS'],
+        }
+        if metrics is not None:
+            self.metrics = metrics
+            self.records = metrics.registry.register(Counter(
+                'hearnear_history_records_total', 'Listening-history records by outcome.', ('result',)))
+        app.extensions['hearnear_history'] = self
+
+    @property
+    def directory(self):
+        return self._settings['directory']
+
+    def _ensure_writer(self):
+        # wątek startuje przy pierwszym rekordzie - już w procesie workera (po fork)
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self._settings['queue_size'])
+            self._thread = threading.Thread(target=self._run, args=(self._queue, dict(self._settings)),
+                                            name='history-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def append(self, user_id, track_id, latitude, longitude, timestamp):
+        """Kolejkuje rekord (timestamp w sekundach od epoki, UTC); nie blokuje żądania."""
+        if not self.enabled:
+            return
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait((user_id, track_id, latitude, longitude, timestamp))
+        except queue.Full:
+            self._count('dropped')
+
+    def flush(self, timeout=5.0):
+        """Zapisuje wszystko, co czeka w kolejce (dla skryptów i zamykania procesu)."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout=5.0):
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _count(self, result, amount=1):
+        if self.records is not None:
+            self.records.inc(amount, result=result)
+
+    def _run(self, inbox, settings):
+        writer = SegmentWriter(settings['directory'], settings['max_bytes'], settings['max_seconds'],
+                               settings['compression_level'], settings['retention_seconds'])
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = inbox.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if isinstance(item, tuple):
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + settings['flush_seconds']
+                if len(batch) < settings['block_records']:
+                    continue
+            # pełny blok, upłynął czas, flush() albo zamknięcie
+            if batch:
+                try:
+                    writer.write_block(batch)
+                    self._count('written', len(batch))
+                except OSError:
+                    self._count('dropped', len(batch))
+                batch = []
+            deadline = None
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                writer.close()
+                return
+
+
+# --- ODCZYT ---
+class SegmentReader:
+    """Odczyt jednego segmentu przez mmap; używany jako context manager."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def blocks(self):
+        """Generator (offset_danych, długość, liczba_rekordów, crc, min_ts_ms, max_ts_ms) kompletnych bloków."""
+        buf = self._map
+        if buf is None or buf[:len(FILE_MAGIC)] != FILE_MAGIC:
+            return
+        offset = len(FILE_MAGIC)
+        end = len(buf)
+        while offset + BLOCK_HEADER.size <= end:
+            length, count, crc, min_ts, max_ts = BLOCK_HEADER.unpack_from(buf, offset)
+            data_offset = offset + BLOCK_HEADER.size
+            if data_offset + length > end:
+                return  # blok właśnie dopisywany
+            yield data_offset, length, count, crc, min_ts, max_ts
+            offset = data_offset + length
+
+    def records(self, since=None, until=None, user_id=None):
+        """Rekordy z since <= timestamp < until (sekundy od epoki), opcjonalnie jednego użytkownika."""
+        since_ms = None if since is None else _to_ms(since)
+        until_ms = None if until is None else _to_ms(until)
+        for data_offset, length, count, crc, min_ts, max_ts in self.blocks():
+            if (since_ms is not None and max_ts < since_ms) or (until_ms is not None and min_ts >= until_ms):
+                continue
+            data = self._map[data_offset:data_offset + length]
+            if zlib.crc32(data) != crc:
+                return  # uszkodzony lub niedokończony zapis
+            raw = zlib.decompress(data)
+            for uid, track_id, lat, lon, ts_ms in RECORD.iter_unpack(raw):
+                if user_id is not None and uid != user_id:
+                    continue
+                if (since_ms is not None and ts_ms < since_ms) or (until_ms is not None and ts_ms >= until_ms):
+                    continue
+                yield HistoryRecord(uid, track_id, lat / COORD_SCALE, lon / COORD_SCALE, ts_ms / 1000)
+
+
+def segment_paths(directory):
+    """Ścieżki segmentów posortowane po czasie otwarcia."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, n) for n in sorted(names) if n.startswith('history-') and n.endswith(SEGMENT_SUFFIX)]
+
+
+def iter_history(directory, since=None, until=None, user_id=None):
+    """
+    Strumieniowo zwraca HistoryRecord ze wszystkich segmentów katalogu.
+    Kolejność: segment po segmencie (rekordy różnych workerów nie są scalane po czasie).
+    """
+    for path in segment_paths(directory):
+        with SegmentReader(path) as reader:
+            yield from reader.records(since, until, user_id)
+
+
+def main():
+    import argparse
+    import csv
+    import sys
+
+    parser = argparse.ArgumentParser(description='Export listening history segments as CSV.')
+    parser.add_argument('directory')
+    parser.add_argument('--since', type=float, help='seconds since epoch (UTC)')
+    parser.add_argument('--until', type=float, help='seconds since epoch (UTC)')
+    parser.add_argument('--user-id', type=int)
+    args = parser.parse_args()
+    out = csv.writer(sys.stdout)
+    out.writerow(HistoryRecord._fields)
+    for record in iter_history(args.directory, args.since, args.until, args.user_id):
+        out.writerow(record)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Wykrywanie pustych pushy aktywności.
+
+Klienci wysyłają /api/update-activity cyklicznie, także gdy nic się nie
+zmieniło. Jeśli utwór jest ten sam, a pozycja przesunęła się mniej niż
+min_move_meters, zapis do bazy jest pomijany - odświeżany jest tylko znacznik
+"ostatnio widziany" w pamięci. Co najmniej raz na heartbeat_seconds zapis
+i tak trafia do bazy, żeby last_updated w tabeli nie zestarzał się poza
+okna max_age_minutes używane w zapytaniach.
+
+Stan jest per proces, a wiersz w bazie mogą w tym czasie zmienić inne
+workery (zapis innego pushu, delete-activity, cleanup-old-activities).
+Dlatego przed pominięciem zapisu serwer sprawdza, czy last_updated wiersza
+to wciąż written_at(user_id) z tego procesu; jeśli nie (wiersz nadpisany lub
+usunięty), stan jest zapominany i push zapisywany normalnie.
+"""
+import threading
+
+from geo import calculate_distance
+
+
+class _State:
+    __slots__ = ('latitude', 'longitude', 'track', 'written_at', 'seen_at')
+
+    def __init__(self, latitude, longitude, track, written_at):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.track = track
+        self.written_at = written_at
+        self.seen_at = written_at
+
+
+class LivenessTracker:
+    def __init__(self, min_move_meters=50.0, heartbeat_seconds=300):
+        self.min_move_meters = min_move_meters
+        self.heartbeat_seconds = heartbeat_seconds
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def touch_if_unchanged(self, user_id, latitude, longitude, track, now):
+        """
+        Zwraca True (i odświeża znacznik w pamięci), gdy push nic nie zmienia
+        i można pominąć zapis do bazy. track to krotka (utwór, artysta, album).
+        """
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None or state.track != track:
+                return False
+            if (now - state.written_at).total_seconds() >= self.heartbeat_seconds:
+                return False
+            moved_m = calculate_distance(state.latitude, state.longitude, latitude, longitude) * 1000
+            if moved_m >= self.min_move_meters:
+                return False
+            state.seen_at = now
+            return True
+
+    def mark_written(self, user_id, latitude, longitude, track, now):
+        with self._lock:
+            self._states[user_id] = _State(latitude, longitude, track, now)
+
+    def written_at(self, user_id):
+        state = self._states.get(user_id)
+        return state.written_at if state is not None else None
+
+    def last_seen(self, user_id):
+        state = self._states.get(user_id)
+        return state.seen_at if state is not None else None
+
+    def forget(self, user_id):
+        with self._lock:
+            self._states.pop(user_id, None)
+
+    def forget_written_before(self, cutoff):
+        with self._lock:
+            for user_id in [uid for uid, st in self._states.items() if st.written_at < cutoff]:
+                del self._states[user_id]
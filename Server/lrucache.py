@@ -0,0 +1,38 @@
+"""
+Prosta, bezpieczna wątkowo pamięć podręczna LRU o ograniczonej liczbie wpisów
+i opcjonalnie ograniczonej sumie rozmiarów (max_bytes, rozmiar podawany w put).
+"""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._data = OrderedDict()  # klucz -> (wartość, rozmiar)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size=0):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._data[key] = (value, size)
+            self.total_bytes += size
+            while self._data and (len(self._data) > self.max_entries
+                                  or (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.total_bytes -= evicted_size
@@ -0,0 +1,315 @@
+"""
+Metryki serwera w formacie tekstowym Prometheusa (bez zewnętrznych zależności).
+
+Użycie:
+    metrics = Metrics(app)
+    metrics.nearby_result_size.observe(len(listeners))
+
+Endpoint /metrics zwraca wszystkie zarejestrowane metryki.
+"""
+import math
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+RESULT_SIZE_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [(n, v) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape_label(v)}"' for n, v in pairs) + '}'
+
+
+class _Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self):
+        """Zwraca listę (sufiks, etykiety, wartości etykiet, dodatkowa etykieta, wartość)."""
+        raise NotImplementedError
+
+    def expose(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}',
+        ]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [('', key, None, value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn):
+        """Wartość liczona w momencie odczytu /metrics (tylko dla gauge bez etykiet)."""
+        self._function = fn
+
+    def samples(self):
+        if self._function is not None:
+            return [('', (), None, self._function())]
+        with self._lock:
+            return [('', key, None, value) for key, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    out.append(('_bucket', key, ('le', _format_value(float(bound))), cumulative))
+                out.append(('_sum', key, None, total))
+                out.append(('_count', key, None, count))
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._by_name = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Rejestruje metrykę i ją zwraca. Jeśli metryka o tej nazwie już istnieje
+        (np. init_app rozszerzenia wywołane dla kolejnej aplikacji w tym samym
+        procesie), zwraca istniejącą - rodzina nie może powtórzyć się w /metrics.
+        """
+        with self._lock:
+            existing = self._by_name.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f'Metric {metric.name} already registered with a different type or labels')
+                return existing
+            self._by_name[metric.name] = metric
+            self._metrics.append(metric)
+        return metric
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(m.expose() for m in metrics) + '\n'
+
+
+def _route_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+class Metrics:
+    """
+    Rozszerzenie Flask zbierające metryki HTTP, SQL i domenowe.
+
+    Liczniki SQL są podpinane pod zdarzenia kursora SQLAlchemy, więc obejmują
+    wszystkie zapytania wykonane w trakcie obsługi żądania.
+    """
+
+    def __init__(self, app=None):
+        self.registry = Registry()
+        r = self.registry.register
+
+        self.http_requests = r(Counter(
+            'hearnear_http_requests_total', 'HTTP requests by route and status.',
+            ('method', 'route', 'status')))
+        self.http_errors = r(Counter(
+            'hearnear_http_request_errors_total', 'HTTP requests that ended with a 5xx status.',
+            ('method', 'route')))
+        self.http_latency = r(Histogram(
+            'hearnear_http_request_duration_seconds', 'HTTP request latency.',
+            ('method', 'route')))
+        self.http_in_flight = r(Gauge(
+            'hearnear_http_requests_in_flight', 'HTTP requests currently being served.',
+            ('route',)))
+        self.db_queries_per_request = r(Histogram(
+            'hearnear_db_queries_per_request', 'SQL statements executed per HTTP request.',
+            ('route',), buckets=QUERY_COUNT_BUCKETS))
+        self.db_time_per_request = r(Histogram(
+            'hearnear_db_query_seconds_per_request', 'Time spent in SQL per HTTP request.',
+            ('route',)))
+        self.db_queries = r(Counter(
+            'hearnear_db_queries_total', 'SQL statements executed.'))
+        self.db_query_seconds = r(Counter(
+            'hearnear_db_query_seconds_total', 'Total time spent executing SQL statements.'))
+        self.cache_requests = r(Counter(
+            'hearnear_cache_requests_total', 'Cache lookups by cache name and result.',
+            ('cache', 'result')))
+        self.cache_hit_ratio = r(Gauge(
+            'hearnear_cache_hit_ratio', 'Cache hit ratio since process start.',
+            ('cache',)))
+        self.active_listeners = r(Gauge(
+            'hearnear_active_listeners', 'Users with a recent activity update.'))
+        self.activity_pushes = r(Counter(
+            'hearnear_activity_pushes_total', 'Activity pushes by outcome (written to DB or suppressed as no-op).',
+            ('result',)))
+        self.presence_errors = r(Counter(
+            'hearnear_presence_errors_total', 'Presence partition calls that failed (server unreachable or timed out).',
+            ('operation',)))
+        self.nearby_result_size = r(Histogram(
+            'hearnear_nearby_listeners_result_size', 'Listeners returned by /api/nearby-listeners.',
+            buckets=RESULT_SIZE_BUCKETS))
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view, methods=['GET'])
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        app.extensions['hearnear_metrics'] = self
+
+    # --- cache ---
+    def cache_hit(self, cache):
+        self.cache_requests.inc(cache=cache, result='hit')
+        self._update_hit_ratio(cache)
+
+    def cache_miss(self, cache):
+        self.cache_requests.inc(cache=cache, result='miss')
+        self._update_hit_ratio(cache)
+
+    def _update_hit_ratio(self, cache):
+        hits = self.cache_requests.get(cache=cache, result='hit')
+        misses = self.cache_requests.get(cache=cache, result='miss')
+        self.cache_hit_ratio.set(hits / (hits + misses), cache=cache)
+
+    # --- hooki żądania ---
+    def _before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_route = _route_label()
+        g.sql_count = 0
+        g.sql_time = 0.0
+        self.http_in_flight.inc(route=g.metrics_route)
+
+    def _after_request(self, response):
+        g.metrics_status = response.status_code
+        return response
+
+    def _teardown_request(self, exc):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return
+        route = g.metrics_route
+        method = request.method
+        status = g.get('metrics_status', 500)
+        self.http_in_flight.dec(route=route)
+        self.http_requests.inc(method=method, route=route, status=status)
+        if status >= 500:
+            self.http_errors.inc(method=method, route=route)
+        self.http_latency.observe(time.perf_counter() - start, method=method, route=route)
+        self.db_queries_per_request.observe(g.sql_count, route=route)
+        self.db_time_per_request.observe(g.sql_time, route=route)
+        self.db_queries.inc(g.sql_count)
+        self.db_query_seconds.inc(g.sql_time)
+
+    def _metrics_view(self):
+        return Response(self.registry.expose(), mimetype='text/plain; version=0.0.4')
+
+
+# --- zdarzenia SQLAlchemy ---
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start_time')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if has_request_context() and 'sql_count' in g:
+        g.sql_count += 1
+        g.sql_time += elapsed
+        statements = g.get('sql_statements')
+        if statements is not None:
+            statements.append((statement, elapsed))
@@ -0,0 +1,451 @@
+"""
+Dane obecności (pozycje aktywnych słuchaczy) podzielone geograficznie na partycje.
+
+Świat jest dzielony na regiony REGION_DEGREES x REGION_DEGREES; każdy region
+należy do jednej partycji (hash regionu modulo liczba partycji). Partycja
+trzyma własny indeks siatkowy pozycji. PresenceRouter:
+  - kieruje update/remove do partycji właściciela regionu (i usuwa wpis
+    ze starej partycji, gdy użytkownik przejdzie do innego regionu),
+  - rozsyła zapytania nearby do wszystkich partycji, których regiony
+    przecinają bbox promienia, i scala wyniki.
+
+Router komunikuje się z partycjami wyłącznie przez szynę (publish / request_many):
+  - InProcessBus     - partycje w tym samym procesie (stand-in za Redis/NATS),
+  - ProcessPartitionBus - każda partycja w osobnym procesie (multiprocessing).
+
+Router z partycjami żyje w jednym procesie. Przy kilku workerach WSGI
+uruchamia się go raz jako PresenceServer (multiprocessing.connection,
+uwierzytelnianie authkey), a workery łączą się przez RemotePresenceRouter -
+ten sam interfejs co PresenceRouter, więc wszystkie widzą te same partycje.
+Ten sam serwer hostuje wspólny TrendingIndex (RemoteTrendingIndex).
+"""
+import heapq
+import itertools
+import math
+import multiprocessing
+import os
+import threading
+from multiprocessing.connection import Client, Listener
+
+from geo import bounding_box, calculate_distance
+
+REGION_DEGREES = 2.0
+INDEX_CELL_DEGREES = 0.1
+
+
+def partition_topic(partition_id):
+    return f'presence.{partition_id}'
+
+
+def region_of(latitude, longitude):
+    return math.floor(latitude / REGION_DEGREES), math.floor(longitude / REGION_DEGREES)
+
+
+class GridIndex:
+    """Indeks siatkowy pozycji użytkowników wewnątrz jednej partycji."""
+
+    def __init__(self, cell_degrees=INDEX_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self._cells = {}  # (wiersz, kolumna) -> {user_id: (lat, lon, ts)}
+        self._user_cell = {}
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def __len__(self):
+        return len(self._user_cell)
+
+    def upsert(self, user_id, latitude, longitude, ts):
+        cell = self._cell(latitude, longitude)
+        old = self._user_cell.get(user_id)
+        if old is not None and old != cell:
+            self._discard(user_id, old)
+        self._cells.setdefault(cell, {})[user_id] = (latitude, longitude, ts)
+        self._user_cell[user_id] = cell
+
+    def remove(self, user_id):
+        cell = self._user_cell.pop(user_id, None)
+        if cell is not None:
+            self._discard(user_id, cell)
+
+    def _discard(self, user_id, cell):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.pop(user_id, None)
+            if not members:
+                del self._cells[cell]
+
+    def remove_older_than(self, cutoff_ts):
+        stale = [uid for members in self._cells.values() for uid, (_, _, ts) in members.items() if ts < cutoff_ts]
+        for user_id in stale:
+            self.remove(user_id)
+        return len(stale)
+
+    def nearby(self, latitude, longitude, radius_km, cutoff_ts, limit=None, after=None):
+        """
+        Lista (odległość_km, user_id, ts) w promieniu, nie starszych niż cutoff_ts.
+        Z limit zwraca tylko limit najbliższych (kopiec ograniczony), z after -
+        tylko wpisy, dla których (odległość, user_id) > after (kursor stronicowania).
+        """
+        min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+        y0, x0 = self._cell(min_lat, min_lon)
+        y1, x1 = self._cell(max_lat, max_lon)
+        result = []
+        if (y1 - y0 + 1) * (x1 - x0 + 1) > len(self._cells):
+            cells = (members for (y, x), members in self._cells.items() if y0 <= y <= y1 and x0 <= x <= x1)
+        else:
+            cells = (self._cells[c] for c in itertools.product(range(y0, y1 + 1), range(x0, x1 + 1)) if c in self._cells)
+        for members in cells:
+            for user_id, (lat, lon, ts) in members.items():
+                if ts < cutoff_ts:
+                    continue
+                distance = calculate_distance(latitude, longitude, lat, lon)
+                if distance <= radius_km and (after is None or (distance, user_id) > after):
+                    result.append((distance, user_id, ts))
+        if limit is not None:
+            return heapq.nsmallest(limit, result)
+        return result
+
+
+class PresencePartition:
+    """Jedna partycja: indeks + obsługa wiadomości z szyny."""
+
+    def __init__(self, partition_id):
+        self.partition_id = partition_id
+        self.index = GridIndex()
+
+    def handle(self, message):
+        kind = message[0]
+        if kind == 'update':
+            _, user_id, latitude, longitude, ts = message
+            self.index.upsert(user_id, latitude, longitude, ts)
+        elif kind == 'remove':
+            self.index.remove(message[1])
+        elif kind == 'expire':
+            return self.index.remove_older_than(message[1])
+        elif kind == 'nearby':
+            _, latitude, longitude, radius_km, cutoff_ts, limit, after = message
+            return self.index.nearby(latitude, longitude, radius_km, cutoff_ts, limit, after)
+        elif kind == 'size':
+            return len(self.index)
+        else:
+            raise ValueError(f'Unknown presence message: {kind}')
+        return None
+
+
+# --- SZYNY ---
+class InProcessBus:
+    """Pub/sub w obrębie procesu; zamiennik brokera do testów i pojedynczej maszyny."""
+
+    def __init__(self):
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic, handler):
+        self._handlers[topic] = handler
+
+    def publish(self, topic, message):
+        with self._lock:
+            self._handlers[topic](message)
+
+    def request_many(self, requests):
+        with self._lock:
+            return [self._handlers[topic](message) for topic, message in requests]
+
+    def close(self):
+        self._handlers.clear()
+
+
+def _partition_main(partition_id, inbox, replies):
+    partition = PresencePartition(partition_id)
+    while True:
+        request_id, message = inbox.get()
+        if message is None:
+            break
+        try:
+            result = partition.handle(message)
+        except Exception as e:  # błąd w partycji nie może zabić procesu
+            result = e
+        if request_id is not None:
+            replies.put((request_id, result))
+
+
+class ProcessPartitionBus:
+    """Każda partycja działa w osobnym procesie; wiadomości idą przez kolejki multiprocessing."""
+
+    def __init__(self, partition_ids, timeout=2.0, start_method='spawn'):
+        ctx = multiprocessing.get_context(start_method)
+        self.timeout = timeout
+        self._replies = ctx.Queue()
+        self._inboxes = {}
+        self._processes = []
+        for partition_id in partition_ids:
+            inbox = ctx.Queue()
+            process = ctx.Process(target=_partition_main, args=(partition_id, inbox, self._replies),
+                                  name=f'presence-{partition_id}', daemon=True)
+            process.start()
+            self._inboxes[partition_topic(partition_id)] = inbox
+            self._processes.append(process)
+        self._ids = itertools.count()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch, name='presence-replies', daemon=True)
+        self._dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            request_id, result = self._replies.get()
+            if request_id is None:
+                break
+            with self._pending_lock:
+                slot = self._pending.pop(request_id, None)
+            if slot is not None:
+                slot[1] = result
+                slot[0].set()
+
+    def publish(self, topic, message):
+        self._inboxes[topic].put((None, message))
+
+    def request_many(self, requests):
+        slots = []
+        for topic, message in requests:
+            request_id = next(self._ids)
+            slot = [threading.Event(), None]
+            with self._pending_lock:
+                self._pending[request_id] = slot
+            self._inboxes[topic].put((request_id, message))
+            slots.append((request_id, slot))
+        results = []
+        for _, (done, _) in slots:
+            if not done.wait(self.timeout):
+                with self._pending_lock:
+                    for request_id, _ in slots:
+                        self._pending.pop(request_id, None)
+                raise TimeoutError('Presence partition did not reply in time')
+        for _, slot in slots:
+            if isinstance(slot[1], Exception):
+                raise slot[1]
+            results.append(slot[1])
+        return results
+
+    def close(self):
+        for inbox in self._inboxes.values():
+            inbox.put((None, None))
+        self._replies.put((None, None))
+        for process in self._processes:
+            process.join(timeout=self.timeout)
+
+
+def start_local_partitions(bus, partition_count):
+    """Tworzy partycje w bieżącym procesie i podpina je pod InProcessBus."""
+    partitions = [PresencePartition(i) for i in range(partition_count)]
+    for partition in partitions:
+        bus.subscribe(partition_topic(partition.partition_id), partition.handle)
+    return partitions
+
+
+class PresenceRouter:
+    def __init__(self, bus, partition_count):
+        self.bus = bus
+        self.partition_count = partition_count
+        self._user_partition = {}
+        self._lock = threading.Lock()
+
+    def partition_for(self, latitude, longitude):
+        return hash(region_of(latitude, longitude)) % self.partition_count
+
+    def update(self, user_id, latitude, longitude, ts):
+        partition_id = self.partition_for(latitude, longitude)
+        with self._lock:
+            previous = self._user_partition.get(user_id)
+            self._user_partition[user_id] = partition_id
+        if previous is not None and previous != partition_id:
+            self.bus.publish(partition_topic(previous), ('remove', user_id))
+        self.bus.publish(partition_topic(partition_id), ('update', user_id, latitude, longitude, ts))
+
+    def remove(self, user_id):
+        with self._lock:
+            partition_id = self._user_partition.pop(user_id, None)
+        if partition_id is not None:
+            self.bus.publish(partition_topic(partition_id), ('remove', user_id))
+
+    def expire(self, cutoff_ts):
+        """Usuwa wpisy starsze niż cutoff_ts ze wszystkich partycji; zwraca liczbę usuniętych."""
+        removed = self.bus.request_many(
+            [(partition_topic(p), ('expire', cutoff_ts)) for p in range(self.partition_count)])
+        return sum(removed)
+
+    def partitions_for_radius(self, latitude, longitude, radius_km):
+        min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+        y0, x0 = region_of(min_lat, min_lon)
+        y1, x1 = region_of(max_lat, max_lon)
+        owners = set()
+        for y in range(y0, y1 + 1):
+            for x in range(x0, x1 + 1):
+                owners.add(hash((y, x)) % self.partition_count)
+                if len(owners) == self.partition_count:
+                    return owners
+        return owners
+
+    def nearby(self, latitude, longitude, radius_km, cutoff_ts, limit=None, after=None):
+        """
+        Scalona lista (odległość_km, user_id, ts) ze wszystkich dotkniętych partycji.
+        Z limit każda partycja zwraca swoje limit najbliższych, a router wybiera
+        z nich globalne limit najbliższych (posortowane).
+        """
+        message = ('nearby', latitude, longitude, radius_km, cutoff_ts, limit, after)
+        partitions = sorted(self.partitions_for_radius(latitude, longitude, radius_km))
+        results = self.bus.request_many([(partition_topic(p), message) for p in partitions])
+        hits = [hit for partial in results for hit in partial]
+        if limit is not None:
+            return heapq.nsmallest(limit, hits)
+        return hits
+
+    def sizes(self):
+        return self.bus.request_many(
+            [(partition_topic(p), ('size',)) for p in range(self.partition_count)])
+
+
+# --- USŁUGA WSPÓLNA DLA WORKERÓW ---
+# Metody dostępne zdalnie dla każdej usługi serwera
+SERVICE_METHODS = {
+    'presence': frozenset({'update', 'remove', 'expire', 'nearby', 'sizes'}),
+    'trending': frozenset({'record', 'forget_user', 'top'}),
+}
+
+
+def parse_address(address):
+    """'host:port' -> (host, port)."""
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class PresenceServer:
+    """
+    Udostępnia wszystkim workerom jeden PresenceRouter (usługa 'presence')
+    i opcjonalnie jeden TrendingIndex (usługa 'trending'); każde połączenie
+    obsługuje osobny wątek.
+    """
+
+    def __init__(self, router, address, authkey, trending=None):
+        self.router = router
+        self._services = {name: obj for name, obj in (('presence', router), ('trending', trending)) if obj is not None}
+        self._listener = Listener(address, authkey=authkey)
+        self._closed = False
+
+    @property
+    def address(self):
+        return self._listener.address
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                if self._closed:
+                    return
+                continue  # zły authkey lub zerwany handshake - odrzucamy klienta, nie serwer
+            threading.Thread(target=self._serve_connection, args=(conn,),
+                             name='presence-client', daemon=True).start()
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    service, method, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                target = self._services.get(service)
+                if target is None or method not in SERVICE_METHODS[service]:
+                    result = ValueError(f'Unknown {service} method: {method}')
+                else:
+                    try:
+                        result = getattr(target, method)(*args)
+                    except Exception as e:  # błąd zwracany klientowi, połączenie zostaje
+                        result = e
+                conn.send(result)
+
+    def close(self):
+        self._closed = True
+        self._listener.close()
+
+
+class _RemoteService:
+    """Klient jednej usługi PresenceServer; jedno połączenie na wątek (i proces)."""
+
+    service = None
+
+    def __init__(self, address, authkey, timeout=2.0):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        # połączenie odziedziczone po fork należy do procesu-rodzica
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = Client(self.address, authkey=self.authkey)
+            self._local.pid = os.getpid()
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+    def _call(self, method, *args):
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.send((self.service, method, args))
+                if not conn.poll(self.timeout):
+                    self._drop_connection()
+                    raise TimeoutError('Presence server did not reply in time')
+                result = conn.recv()
+                break
+            except (EOFError, ConnectionError):
+                # serwer zrestartowany - jedna próba na nowym połączeniu
+                self._drop_connection()
+                if attempt:
+                    raise
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class RemotePresenceRouter(_RemoteService):
+    """Interfejs PresenceRouter nad usługą 'presence' wspólnego serwera."""
+
+    service = 'presence'
+
+    def update(self, user_id, latitude, longitude, ts):
+        self._call('update', user_id, latitude, longitude, ts)
+
+    def remove(self, user_id):
+        self._call('remove', user_id)
+
+    def expire(self, cutoff_ts):
+        return self._call('expire', cutoff_ts)
+
+    def nearby(self, latitude, longitude, radius_km, cutoff_ts, limit=None, after=None):
+        return self._call('nearby', latitude, longitude, radius_km, cutoff_ts, limit, after)
+
+    def sizes(self):
+        return self._call('sizes')
+
+
+class RemoteTrendingIndex(_RemoteService):
+    """Interfejs TrendingIndex (trending.py) nad usługą 'trending' wspólnego serwera."""
+
+    service = 'trending'
+
+    def record(self, user_id, latitude, longitude, track_name, artist_name):
+        return self._call('record', user_id, latitude, longitude, track_name, artist_name)
+
+    def forget_user(self, user_id):
+        self._call('forget_user', user_id)
+
+    def top(self, latitude, longitude, radius_km, window_minutes=60, limit=10):
+        return self._call('top', latitude, longitude, radius_km, window_minutes, limit)
@@ -0,0 +1,137 @@
+"""
+Opcjonalne profilowanie żądań i śledzenie zapytań SQL.
+
+Profilowanie włącza się:
+  - nagłówkiem PROFILING_HEADER z wartością równą PROFILING_HEADER_SECRET,
+  - albo losowo dla części żądań (PROFILING_SAMPLE_RATE, 0.0 - 1.0).
+
+Profil zapisywany jest do PROFILING_DIR w formacie cProfile (.prof),
+do wczytania przez `python -m pstats plik.prof` lub snakeviz. Obok trafia
+lista wykonanych zapytań SQL z czasami (.sql.txt).
+
+Niezależnie od profilowania każde żądanie przekraczające
+SLOW_REQUEST_QUERY_COUNT zapytań lub SLOW_REQUEST_QUERY_SECONDS czasu w SQL
+jest logowane jako ostrzeżenie i liczone w metryce hearnear_slow_requests_total.
+Gdy profilowanie jest wyłączone, koszt to jedno porównanie na żądanie.
+"""
+import cProfile
+import itertools
+import logging
+import os
+import random
+import re
+import time
+
+from flask import current_app, g, request
+
+from metrics import Counter
+
+logger = logging.getLogger('hearnear.profiling')
+sql_logger = logging.getLogger('hearnear.sql')
+_dump_ids = itertools.count()
+
+DEFAULTS = {
+    'PROFILING_SAMPLE_RATE': 0.0,
+    'PROFILING_HEADER': 'X-HearNear-Profile',
+    'PROFILING_HEADER_SECRET': None,
+    'PROFILING_DIR': None,  # domyślnie <instance>/profiles
+    'SQL_TRACE': False,  # loguj każde zapytanie (także bez profilowania)
+    'SLOW_REQUEST_QUERY_COUNT': 25,
+    'SLOW_REQUEST_QUERY_SECONDS': 0.25,
+}
+
+
+def _slug(route):
+    return re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+
+
+class RequestProfiler:
+    def __init__(self, app=None, metrics=None):
+        self.metrics = metrics
+        self.slow_requests = None
+        if app is not None:
+            self.init_app(app, metrics)
+
+    def init_app(self, app, metrics=None):
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        if metrics is not None:
+            self.metrics = metrics
+            self.slow_requests = metrics.registry.register(Counter(
+                'hearnear_slow_requests_total', 'Requests over the SQL count/time threshold.',
+                ('route', 'reason')))
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.extensions['hearnear_profiler'] = self
+
+    def _wants_profile(self, config):
+        secret = config['PROFILING_HEADER_SECRET']
+        if secret and request.headers.get(config['PROFILING_HEADER']) == secret:
+            return True
+        rate = config['PROFILING_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def _before_request(self):
+        config = current_app.config
+        trace = config['SQL_TRACE']
+        if not (trace or config['PROFILING_SAMPLE_RATE'] or config['PROFILING_HEADER_SECRET']):
+            return
+        profile_this = self._wants_profile(config)
+        if trace or profile_this:
+            g.sql_statements = []
+        if profile_this:
+            profile = cProfile.Profile()
+            g.profiler = profile
+            profile.enable()
+
+    def _after_request(self, response):
+        profile = g.pop('profiler', None)
+        if profile is not None:
+            profile.disable()
+            response.headers['X-HearNear-Profile-Id'] = self._dump(profile)
+        return response
+
+    def _teardown_request(self, exc):
+        profile = g.pop('profiler', None)
+        if profile is not None:
+            # żądanie zakończone wyjątkiem - after_request mógł nie zostać wywołany
+            profile.disable()
+
+        statements = g.pop('sql_statements', None)
+        route = g.get('metrics_route') or (request.url_rule.rule if request.url_rule else 'unmatched')
+        if statements:
+            for statement, elapsed in statements:
+                sql_logger.info('%s %.2fms %s', route, elapsed * 1000, ' '.join(statement.split()))
+
+        self._flag_slow(route, g.get('sql_count', 0), g.get('sql_time', 0.0))
+
+    def _flag_slow(self, route, count, seconds):
+        config = current_app.config
+        reasons = []
+        if count > config['SLOW_REQUEST_QUERY_COUNT']:
+            reasons.append('query_count')
+        if seconds > config['SLOW_REQUEST_QUERY_SECONDS']:
+            reasons.append('query_time')
+        if not reasons:
+            return
+        logger.warning('Slow request %s %s: %d queries, %.1fms in SQL',
+                       request.method, route, count, seconds * 1000)
+        if self.slow_requests is not None:
+            for reason in reasons:
+                self.slow_requests.inc(route=route, reason=reason)
+
+    def _dump(self, profile):
+        directory = current_app.config['PROFILING_DIR'] or os.path.join(current_app.instance_path, 'profiles')
+        os.makedirs(directory, exist_ok=True)
+        route = g.get('metrics_route') or request.path
+        # pid + licznik procesu: równoległe profile tej samej trasy w tej samej ms się nie nadpisują
+        name = (f"{time.strftime('%Y%m%d-%H%M%S')}_{int(time.time() * 1000) % 1000:03d}"
+                f"_{os.getpid()}-{next(_dump_ids)}_{request.method}_{_slug(route)}")
+        profile.dump_stats(os.path.join(directory, name + '.prof'))
+        statements = g.get('sql_statements')
+        if statements is not None:
+            with open(os.path.join(directory, name + '.sql.txt'), 'w', encoding='utf-8') as fh:
+                for statement, elapsed in statements:
+                    fh.write(f"{elapsed * 1000:.3f}ms\t{' '.join(statement.split())}\n")
+        return name
@@ -1,29 +1,121 @@
-from flask import Flask, request, jsonify, send_from_directory
+"""
+Serwer HearNear (Flask).
+
+Aplikację tworzy fabryka create_app(); do serwera WSGI służy wsgi.py
+(np. `gunicorn wsgi:app`). Schemat bazy i indeksy tworzy się jawnie:
+    flask --app python_auth_server init-db
+Uruchomienie `python python_auth_server.py` robi oba kroki i startuje serwer deweloperski.
+"""
+from flask import Blueprint, Flask, current_app, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.exc import IntegrityError
+import click
 import jwt
 import datetime
 from functools import wraps
-import re
+import heapq
+import logging
 import math
+import re
 import os
+import threading
 from werkzeug.utils import secure_filename
-from PIL import Image
+
+from admission import AdmissionControl
+from avatar_delivery import avatar_response
+from compression import Compression
+from geo import bounding_box, calculate_distance
+from history_log import HistoryLog
+from liveness import LivenessTracker
+from lrucache import LRUCache
+from metrics import Metrics
+from presence import (InProcessBus, PresenceRouter, PresenceServer, ProcessPartitionBus, RemotePresenceRouter,
+                      RemoteTrendingIndex, parse_address, start_local_partitions)
+from profiling import RequestProfiler
+from trending import MAX_WINDOW_MINUTES, TrendingIndex
 
 # --- KONFIG ---
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-change-this'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hearnear.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Upload / avatar settings
-app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static', 'avatars')
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-app.config['MAX_CONTENT_LENGTH'] = 3 * 1024 * 1024  # 3 MB max upload
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
 MAX_AVATAR_SIZE = (512, 512)
 
-db = SQLAlchemy(app)
+# Maksymalny rozmiar strony w /api/nearby-listeners?limit=
+MAX_NEARBY_LIMIT = 200
+
+# Granice parametrów /api/trending-nearby (promień do połowy obwodu Ziemi)
+MAX_TRENDING_LIMIT = 50
+MAX_TRENDING_RADIUS_KM = 20000
+
+# Liczba par (utwór, artysta, album) -> Track.id trzymanych w pamięci
+TRACK_INTERN_CACHE_SIZE = 50000
+
+
+def _config_from_env():
+    return {
+        'SECRET_KEY': 'your-secret-key-change-this',
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///hearnear.db',
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+
+        # Upload / avatar settings (katalog tworzony przy pierwszym uploadzie)
+        'MAX_CONTENT_LENGTH': 3 * 1024 * 1024,  # 3 MB max upload
+        # Sposób wysyłania avatarów (patrz avatar_delivery.py): python | sendfile | x-accel | x-sendfile
+        'AVATAR_DELIVERY': os.environ.get('HEARNEAR_AVATAR_DELIVERY', 'python'),
+        'AVATAR_ACCEL_PREFIX': os.environ.get('HEARNEAR_AVATAR_ACCEL_PREFIX', '/_protected_avatars/'),
+
+        # Profilowanie / śledzenie SQL (patrz profiling.py); domyślnie wyłączone
+        'PROFILING_SAMPLE_RATE': float(os.environ.get('HEARNEAR_PROFILING_SAMPLE_RATE', 0.0)),
+        'PROFILING_HEADER_SECRET': os.environ.get('HEARNEAR_PROFILING_SECRET'),
+        'SQL_TRACE': os.environ.get('HEARNEAR_SQL_TRACE') == '1',
+
+        # Pomijanie pustych pushy aktywności (patrz liveness.py)
+        'ACTIVITY_MIN_MOVE_METERS': float(os.environ.get('HEARNEAR_ACTIVITY_MIN_MOVE_METERS', 50)),
+        'ACTIVITY_HEARTBEAT_SECONDS': int(os.environ.get('HEARNEAR_ACTIVITY_HEARTBEAT_SECONDS', 300)),
+
+        # Kompresja odpowiedzi (patrz compression.py)
+        'COMPRESSION_MIN_SIZE': int(os.environ.get('HEARNEAR_COMPRESSION_MIN_SIZE', 1024)),
+        'COMPRESSION_LEVELS': {
+            'br': int(os.environ.get('HEARNEAR_BROTLI_LEVEL', 5)),
+            'zstd': int(os.environ.get('HEARNEAR_ZSTD_LEVEL', 3)),
+            'gzip': int(os.environ.get('HEARNEAR_GZIP_LEVEL', 6)),
+        },
+
+        # Historia słuchania w segmentach poza bazą (patrz history_log.py); domyślnie <instance>/history
+        'HISTORY_ENABLED': os.environ.get('HEARNEAR_HISTORY_ENABLED') == '1',
+        'HISTORY_DIR': os.environ.get('HEARNEAR_HISTORY_DIR'),
+        'HISTORY_RETENTION_SECONDS': int(os.environ.get('HEARNEAR_HISTORY_RETENTION_SECONDS', 30 * 24 * 3600)),
+
+        # Kontrola przyjmowania żądań (patrz admission.py); 0 = bez limitu współbieżności
+        'ADMISSION_MAX_CONCURRENCY': int(os.environ.get('HEARNEAR_ADMISSION_MAX_CONCURRENCY', 0)),
+        'ADMISSION_STALE_MAX_AGE': int(os.environ.get('HEARNEAR_ADMISSION_STALE_MAX_AGE', 120)),
+        'ADMISSION_RETRY_AFTER': int(os.environ.get('HEARNEAR_ADMISSION_RETRY_AFTER', 2)),
+
+        # Partycjonowanie danych obecności (patrz presence.py); 0 = wyszukiwanie bezpośrednio w bazie
+        'PRESENCE_PARTITIONS': int(os.environ.get('HEARNEAR_PRESENCE_PARTITIONS', 0)),
+        # 'inprocess' | 'process' - partycje wewnątrz tego procesu (tylko jeden worker),
+        # 'remote' - wspólny serwer partycji (`flask --app python_auth_server presence-serve`)
+        'PRESENCE_MODE': os.environ.get('HEARNEAR_PRESENCE_MODE', 'inprocess'),
+        'PRESENCE_ADDRESS': os.environ.get('HEARNEAR_PRESENCE_ADDRESS', '127.0.0.1:7781'),
+        'PRESENCE_AUTHKEY': os.environ.get('HEARNEAR_PRESENCE_AUTHKEY'),  # domyślnie SECRET_KEY
+        # 'local' - indeks w tym procesie (tylko jeden worker), 'remote' - wspólny indeks
+        # w serwerze `presence-serve`, 'off' - /api/trending-nearby zwraca 503
+        'TRENDING_MODE': os.environ.get('HEARNEAR_TRENDING_MODE', 'local'),
+        # jeden proces obsługuje wszystkie żądania - lokalne partycje i trending są poprawne
+        'SINGLE_WORKER': os.environ.get('HEARNEAR_SINGLE_WORKER') == '1',
+    }
+
+
+db = SQLAlchemy()
+metrics = Metrics()
+profiler = RequestProfiler()
+compression = Compression()
+trending = TrendingIndex()
+liveness = LivenessTracker()
+history = HistoryLog()
+admission = AdmissionControl()
+track_ids = LRUCache(TRACK_INTERN_CACHE_SIZE)
+api = Blueprint('api', __name__)
+
+# Okno, w którym użytkownik liczy się jako aktywny słuchacz (gauge w /metrics)
+ACTIVE_LISTENER_WINDOW_MINUTES = 60
 
 # --- MODELE ---
 class User(db.Model):
@@ -36,17 +128,58 @@ class User(db.Model):
     avatar_filename = db.Column(db.String(200), unique=False, nullable=True)
 
 
+class Track(db.Model):
+    """
+    Znormalizowany katalog utworów - każda trójka (utwór, artysta, album) zapisana raz.
+    Brak albumu to '' (NULL w UNIQUE nie blokowałby duplikatów).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    track_name = db.Column(db.String(200), nullable=False)
+    artist_name = db.Column(db.String(200), nullable=False)
+    album_name = db.Column(db.String(200), nullable=False, default='')
+
+    __table_args__ = (
+        db.UniqueConstraint('track_name', 'artist_name', 'album_name', name='uq_track'),
+        db.Index('ix_track_artist_name', 'artist_name'),
+    )
+
+    def to_dict(self):
+        return {
+            'track_name': self.track_name,
+            'artist_name': self.artist_name,
+            'album_name': self.album_name or None
+        }
+
+
 class UserActivity(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
-    track_name = db.Column(db.String(200), nullable=False)
-    artist_name = db.Column(db.String(200), nullable=False)
-    album_name = db.Column(db.String(200), nullable=True)
+    track_id = db.Column(db.Integer, db.ForeignKey('track.id'), nullable=False)
     last_updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
     user = db.relationship('User', backref=db.backref('activities', lazy=True))
+    track = db.relationship('Track', lazy='joined')
+
+    __table_args__ = (
+        db.Index('ix_user_activity_lat_lon', 'latitude', 'longitude'),
+        db.Index('ix_user_activity_last_updated', 'last_updated'),
+        db.Index('ix_user_activity_track_id', 'track_id'),
+        db.Index('ix_user_activity_user_id', 'user_id'),
+    )
+
+    @property
+    def track_name(self):
+        return self.track.track_name
+
+    @property
+    def artist_name(self):
+        return self.track.artist_name
+
+    @property
+    def album_name(self):
+        return self.track.album_name or None
 
 
 class Friendship(db.Model):
@@ -71,6 +204,151 @@ class Friendship(db.Model):
     )
 
 
+def _count_active_listeners():
+    cutoff_time = datetime.datetime.utcnow() - datetime.timedelta(minutes=ACTIVE_LISTENER_WINDOW_MINUTES)
+    return UserActivity.query.filter(UserActivity.last_updated >= cutoff_time).count()
+
+
+metrics.active_listeners.set_function(_count_active_listeners)
+
+
+# --- PARTYCJE OBECNOŚCI ---
+logger = logging.getLogger('hearnear.presence')
+EPOCH = datetime.datetime(1970, 1, 1)
+# Wynik _presence_call, gdy partycje są niedostępne
+PRESENCE_UNAVAILABLE = object()
+_presence_router = None
+_remote_trending = None
+_presence_lock = threading.Lock()
+
+
+def _utc_timestamp(dt):
+    return (dt - EPOCH).total_seconds()
+
+
+def _presence_authkey(config):
+    return (config['PRESENCE_AUTHKEY'] or config['SECRET_KEY']).encode()
+
+
+def build_local_presence_router(partition_count, separate_processes=False):
+    """Router z partycjami w tym procesie (lub w procesach potomnych), zasilony z bazy."""
+    if separate_processes:
+        bus = ProcessPartitionBus(range(partition_count))
+    else:
+        bus = InProcessBus()
+        start_local_partitions(bus, partition_count)
+    router = PresenceRouter(bus, partition_count)
+    for activity in UserActivity.query.all():
+        router.update(activity.user_id, activity.latitude, activity.longitude,
+                      _utc_timestamp(activity.last_updated))
+    return router
+
+
+def get_presence_router():
+    """
+    Zwraca router partycji lub None, gdy wyłączone. W trybie 'remote' jest to
+    klient wspólnego serwera partycji; w pozostałych - lokalny router tworzony
+    i zasilany z bazy przy pierwszym użyciu (poprawny tylko przy jednym workerze).
+    """
+    global _presence_router
+    config = current_app.config
+    partition_count = config['PRESENCE_PARTITIONS']
+    if partition_count <= 0:
+        return None
+    if _presence_router is None:
+        with _presence_lock:
+            if _presence_router is None:
+                if config['PRESENCE_MODE'] == 'remote':
+                    _presence_router = RemotePresenceRouter(
+                        parse_address(config['PRESENCE_ADDRESS']), _presence_authkey(config))
+                else:
+                    _presence_router = build_local_presence_router(
+                        partition_count, config['PRESENCE_MODE'] == 'process')
+    return _presence_router
+
+
+def _presence_call(method, *args, **kwargs):
+    """
+    Wywołuje metodę routera partycji. Niedostępny serwer partycji (lub partycja,
+    która nie odpowiedziała) nie może zepsuć żądania, które już zapisało dane
+    w bazie - błąd jest logowany, liczony i zwracany jako PRESENCE_UNAVAILABLE.
+    """
+    try:
+        return method(*args, **kwargs)
+    except (OSError, EOFError) as e:  # ConnectionError, TimeoutError, zerwane połączenie
+        logger.warning('Presence %s failed: %s', method.__name__, e)
+        metrics.presence_errors.inc(operation=method.__name__)
+        return PRESENCE_UNAVAILABLE
+
+
+def get_trending_index():
+    """
+    Zwraca indeks trending: lokalny (TRENDING_MODE='local'), klienta wspólnego
+    indeksu w serwerze `presence-serve` ('remote') albo None ('off').
+    """
+    global _remote_trending
+    config = current_app.config
+    mode = config['TRENDING_MODE']
+    if mode == 'local':
+        return trending
+    if mode != 'remote':
+        return None
+    if _remote_trending is None:
+        with _presence_lock:
+            if _remote_trending is None:
+                _remote_trending = RemoteTrendingIndex(
+                    parse_address(config['PRESENCE_ADDRESS']), _presence_authkey(config))
+    return _remote_trending
+
+
+def check_presence_deployment(config):
+    """
+    Stan trzymany w procesie (partycje, indeks trending) przy wielu workerach
+    dałby każdemu workerowi inną, niepełną kopię. Lokalne partycje blokują start;
+    lokalny trending zostaje wyłączony (endpoint zwraca 503), żeby domyślna
+    konfiguracja nadal startowała.
+    """
+    if config['SINGLE_WORKER']:
+        return
+    if config['PRESENCE_PARTITIONS'] > 0 and config['PRESENCE_MODE'] != 'remote':
+        raise RuntimeError(
+            'PRESENCE_PARTITIONS > 0 with PRESENCE_MODE=%r keeps partitions inside each worker. '
+            'Run `flask --app python_auth_server presence-serve` and set HEARNEAR_PRESENCE_MODE=remote, '
+            'or set HEARNEAR_SINGLE_WORKER=1 when running a single worker.' % config['PRESENCE_MODE'])
+    if config['TRENDING_MODE'] == 'local':
+        logger.warning('TRENDING_MODE=local keeps the trending index inside each worker; /api/trending-nearby '
+                       'is disabled. Run `presence-serve` and set HEARNEAR_TRENDING_MODE=remote, '
+                       'or set HEARNEAR_SINGLE_WORKER=1 when running a single worker.')
+        config['TRENDING_MODE'] = 'off'
+
+
+# --- KATALOG UTWORÓW ---
+def intern_track(track_name, artist_name, album_name):
+    """
+    Zwraca Track.id dla trójki (utwór, artysta, album), tworząc wiersz w razie potrzeby.
+    Do pamięci trafiają tylko id odczytane z bazy (zatwierdzone), więc wycofana
+    transakcja nie zostawi w cache id nieistniejącego wiersza.
+    """
+    key = (track_name, artist_name, album_name or '')
+    track_id = track_ids.get(key)
+    if track_id is not None:
+        metrics.cache_hit('track_intern')
+        return track_id
+    metrics.cache_miss('track_intern')
+    track = Track.query.filter_by(track_name=key[0], artist_name=key[1], album_name=key[2]).first()
+    if track is not None:
+        track_ids.put(key, track.id)
+        return track.id
+    try:
+        with db.session.begin_nested():
+            track = Track(track_name=key[0], artist_name=key[1], album_name=key[2])
+            db.session.add(track)
+    except IntegrityError:
+        # równoległe żądanie właśnie dodało ten sam utwór
+        track = Track.query.filter_by(track_name=key[0], artist_name=key[1], album_name=key[2]).one()
+    return track.id
+
+
 # --- WALIDATORY ---
 def validate_email(email):
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -85,20 +363,25 @@ def validate_instagram_username(username: str) -> bool:
     return re.match(pattern, username) is not None
 
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    R = 6371
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-    dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
-    a = math.sin(dlat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
+# --- AUTH ---
+def _decode_token(token):
+    """Zwraca user_id z tokenu JWT (z prefiksem 'Bearer ' lub bez); rzuca wyjątek jwt przy złym/przeterminowanym."""
+    if token.startswith('Bearer '):
+        token = token[7:]
+    return jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])['user_id']
+
+
+def _request_user_id():
+    """user_id z ważnego tokenu bieżącego żądania (bez zapytania do bazy) albo None."""
+    token = request.headers.get('Authorization')
+    if not token:
+        return None
+    try:
+        return _decode_token(token)
+    except (jwt.InvalidTokenError, KeyError):
+        return None
 
 
-# --- AUTH ---
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -106,10 +389,7 @@ def token_required(f):
         if not token:
             return jsonify({'error': 'Token is missing'}), 401
         try:
-            if token.startswith('Bearer '):
-                token = token[7:]
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-            current_user = User.query.get(data['user_id'])
+            current_user = User.query.get(_decode_token(token))
             if not current_user:
                 raise Exception("User not found")
         except Exception as e:
@@ -127,6 +407,8 @@ def process_and_save_avatar(file_storage, user_id):
     filename = secure_filename(file_storage.filename)
     if not allowed_file(filename):
         raise ValueError('Bad file extension')
+    from PIL import Image  # import leniwy - potrzebny tylko przy uploadzie
+
     try:
         file_storage.stream.seek(0)
         img = Image.open(file_storage.stream)
@@ -137,7 +419,8 @@ def process_and_save_avatar(file_storage, user_id):
     img = Image.open(file_storage.stream).convert('RGB')
     base_name = f"user_{user_id}_{int(datetime.datetime.utcnow().timestamp())}"
     out_name = f"{base_name}.webp"
-    out_path = os.path.join(app.config['UPLOAD_FOLDER'], out_name)
+    os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
+    out_path = os.path.join(current_app.config['UPLOAD_FOLDER'], out_name)
     img.thumbnail(MAX_AVATAR_SIZE)
     img.save(out_path, format='WEBP', quality=85)
     return out_name
@@ -154,8 +437,56 @@ def _user_info(user):
     }
 
 
+def _last_seen(activity):
+    """last_updated z bazy lub nowszy znacznik z pominiętego (pustego) pusha."""
+    seen = liveness.last_seen(activity.user_id)
+    return seen if seen is not None and seen > activity.last_updated else activity.last_updated
+
+
+def _stored_activity_is_ours(user_id):
+    """Czy wiersz aktywności w bazie to wciąż ten, który ten proces zapisał ostatnio."""
+    row = db.session.query(UserActivity.last_updated).filter_by(user_id=user_id).first()
+    return row is not None and row.last_updated == liveness.written_at(user_id)
+
+
+def _listener_info(activity, distance_km, compact=False):
+    """compact=True pomija nazwy utworu - klient bierze je ze słownika 'tracks' odpowiedzi."""
+    last_updated = _last_seen(activity)
+    info = {
+        'user_id': activity.user_id,
+        'email': activity.user.email,
+        'nick': activity.user.nick,
+        'distance_km': distance_km,
+        'latitude': activity.latitude,
+        'longitude': activity.longitude,
+        'track_id': activity.track_id,
+        'last_updated': last_updated.isoformat(),
+        'minutes_ago': int((datetime.datetime.utcnow() - last_updated).total_seconds() / 60),
+        'instagram_username': activity.user.instagram_username,
+        'instagram_url': f'https://instagram.com/{activity.user.instagram_username}' if activity.user.instagram_username else None,
+        'avatar_url': f'/avatars/{activity.user.avatar_filename}' if activity.user.avatar_filename else None
+    }
+    if not compact:
+        info.update(activity.track.to_dict())
+    return info
+
+
+def _track_dictionary(activities):
+    """Słownik {track_id: {...}} z każdym utworem raz - do odpowiedzi z ?track_dict=1."""
+    return {str(a.track_id): a.track.to_dict() for a in activities}
+
+
+def _parse_nearby_cursor(cursor):
+    """Kursor ma postać '<odległość_km>:<user_id>' (ostatni element poprzedniej strony)."""
+    distance, user_id = cursor.split(':', 1)
+    distance = float(distance)
+    if not math.isfinite(distance):  # 'nan' / 'inf' przechodzą przez float()
+        raise ValueError('Cursor distance must be finite')
+    return distance, int(user_id)
+
+
 # --- ENDPOINTY AUTH ---
-@app.route('/api/register', methods=['POST'])
+@api.route('/api/register', methods=['POST'])
 def register():
     try:
         data = request.get_json()
@@ -185,6 +516,7 @@ def register():
                 return jsonify({'error': 'Invalid Instagram username format'}), 400
             if User.query.filter_by(instagram_username=instagram_username).first():
                 return jsonify({'error': 'Instagram username already linked to another account'}), 409
+        from werkzeug.security import generate_password_hash
         password_hash = generate_password_hash(password)
         new_user = User(nick=nick, email=email, password_hash=password_hash, instagram_username=instagram_username)
         db.session.add(new_user)
@@ -192,13 +524,13 @@ def register():
         token = jwt.encode({
             'user_id': new_user.id,
             'exp': datetime.datetime.utcnow() + datetime.timedelta(days=30)
-        }, app.config['SECRET_KEY'], algorithm='HS256')
+        }, current_app.config['SECRET_KEY'], algorithm='HS256')
         return jsonify({'message': 'User registered successfully', 'token': token, 'user': _user_info(new_user)}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login():
     try:
         data = request.get_json()
@@ -206,32 +538,33 @@ def login():
             return jsonify({'error': 'Email and password required'}), 400
         email = data['email'].strip().lower()
         password = data['password']
+        from werkzeug.security import check_password_hash
         user = User.query.filter_by(email=email).first()
         if not user or not check_password_hash(user.password_hash, password):
             return jsonify({'error': 'Invalid credentials'}), 401
         token = jwt.encode({
             'user_id': user.id,
             'exp': datetime.datetime.utcnow() + datetime.timedelta(days=30)
-        }, app.config['SECRET_KEY'], algorithm='HS256')
+        }, current_app.config['SECRET_KEY'], algorithm='HS256')
         return jsonify({'message': 'Login successful', 'token': token, 'user': _user_info(user)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/verify-token', methods=['POST'])
+@api.route('/api/verify-token', methods=['POST'])
 @token_required
 def verify_token(current_user):
     return jsonify({'valid': True, 'user': _user_info(current_user)}), 200
 
 
-@app.route('/api/logout', methods=['POST'])
+@api.route('/api/logout', methods=['POST'])
 @token_required
 def logout(current_user):
     return jsonify({'message': 'Logout successful'}), 200
 
 
 # --- INSTAGRAM ---
-@app.route('/api/instagram', methods=['POST'])
+@api.route('/api/instagram', methods=['POST'])
 @token_required
 def add_or_update_instagram(current_user):
     try:
@@ -260,7 +593,7 @@ def add_or_update_instagram(current_user):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/instagram', methods=['DELETE'])
+@api.route('/api/instagram', methods=['DELETE'])
 @token_required
 def delete_instagram(current_user):
     try:
@@ -274,7 +607,7 @@ def delete_instagram(current_user):
 
 
 # --- AVATARY ---
-@app.route('/api/avatar', methods=['POST'])
+@api.route('/api/avatar', methods=['POST'])
 @token_required
 def upload_avatar(current_user):
     try:
@@ -286,7 +619,7 @@ def upload_avatar(current_user):
         new_filename = process_and_save_avatar(file, current_user.id)
         if current_user.avatar_filename:
             try:
-                old_path = os.path.join(app.config['UPLOAD_FOLDER'], current_user.avatar_filename)
+                old_path = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.avatar_filename)
                 if os.path.exists(old_path):
                     os.remove(old_path)
             except Exception:
@@ -300,13 +633,13 @@ def upload_avatar(current_user):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/avatar', methods=['DELETE'])
+@api.route('/api/avatar', methods=['DELETE'])
 @token_required
 def delete_avatar(current_user):
     try:
         if not current_user.avatar_filename:
             return jsonify({'message': 'No avatar to delete'}), 404
-        path = os.path.join(app.config['UPLOAD_FOLDER'], current_user.avatar_filename)
+        path = os.path.join(current_app.config['UPLOAD_FOLDER'], current_user.avatar_filename)
         if os.path.exists(path):
             os.remove(path)
         current_user.avatar_filename = None
@@ -316,13 +649,13 @@ def delete_avatar(current_user):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/avatars/<filename>', methods=['GET'])
+@api.route('/avatars/<filename>', methods=['GET'])
 def serve_avatar(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return avatar_response(filename)
 
 
 # --- AKTYWNOŚĆ ---
-@app.route('/api/update-activity', methods=['POST'])
+@api.route('/api/update-activity', methods=['POST'])
 @token_required
 def update_activity(current_user):
     try:
@@ -339,27 +672,45 @@ def update_activity(current_user):
             return jsonify({'error': 'Invalid latitude'}), 400
         if not (-180 <= longitude <= 180):
             return jsonify({'error': 'Invalid longitude'}), 400
-        existing_activity = UserActivity.query.filter_by(user_id=current_user.id).first()
-        if existing_activity:
-            existing_activity.latitude = latitude
-            existing_activity.longitude = longitude
-            existing_activity.track_name = track_name
-            existing_activity.artist_name = artist_name
-            existing_activity.album_name = album_name
-            existing_activity.last_updated = datetime.datetime.utcnow()
-        else:
-            new_activity = UserActivity(
-                user_id=current_user.id, latitude=latitude, longitude=longitude,
-                track_name=track_name, artist_name=artist_name, album_name=album_name
-            )
-            db.session.add(new_activity)
-        db.session.commit()
+        now = datetime.datetime.utcnow()
+        track = (track_name, artist_name, album_name)
+        suppressed = liveness.touch_if_unchanged(current_user.id, latitude, longitude, track, now)
+        if suppressed and not _stored_activity_is_ours(current_user.id):
+            # wiersz usunięty lub nadpisany przez inny worker - stan w pamięci jest nieaktualny
+            liveness.forget(current_user.id)
+            suppressed = False
+        written = not suppressed
+        if written:
+            track_id = intern_track(track_name, artist_name, album_name)
+            existing_activity = UserActivity.query.filter_by(user_id=current_user.id).first()
+            if existing_activity:
+                existing_activity.latitude = latitude
+                existing_activity.longitude = longitude
+                existing_activity.track_id = track_id
+                existing_activity.last_updated = now
+            else:
+                new_activity = UserActivity(
+                    user_id=current_user.id, latitude=latitude, longitude=longitude,
+                    track_id=track_id, last_updated=now
+                )
+                db.session.add(new_activity)
+            db.session.commit()
+            liveness.mark_written(current_user.id, latitude, longitude, track, now)
+            index = get_trending_index()
+            if index is not None:
+                _presence_call(index.record, current_user.id, latitude, longitude, track_name, artist_name)
+            history.append(current_user.id, track_id, latitude, longitude, _utc_timestamp(now))
+        metrics.activity_pushes.inc(result='written' if written else 'suppressed')
+        router = get_presence_router()
+        if router is not None:
+            _presence_call(router.update, current_user.id, latitude, longitude, _utc_timestamp(now))
         return jsonify({
             'message': 'Activity updated successfully',
+            'written': written,
             'activity': {
                 'latitude': latitude, 'longitude': longitude,
                 'track_name': track_name, 'artist_name': artist_name,
-                'album_name': album_name, 'last_updated': datetime.datetime.utcnow().isoformat()
+                'album_name': album_name, 'last_updated': now.isoformat()
             }
         }), 200
     except ValueError:
@@ -368,15 +719,17 @@ def update_activity(current_user):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/friends/activity', methods=['GET'])
+@api.route('/api/friends/activity', methods=['GET'])
 @token_required
 def get_friends_activity(current_user):
     """
     Zwraca aktywność wszystkich zaakceptowanych znajomych,
     którzy aktualnie udostępniają muzykę (bez limitu odległości).
+    ?track_dict=1 - utwory raz w słowniku 'tracks', u słuchaczy tylko track_id.
     """
     try:
         max_age_minutes = request.args.get('max_age_minutes', 60, type=int)
+        compact = request.args.get('track_dict') == '1'
         cutoff_time = datetime.datetime.utcnow() - datetime.timedelta(minutes=max_age_minutes)
 
         # Pobierz wszystkich zaakceptowanych znajomych
@@ -417,109 +770,177 @@ def get_friends_activity(current_user):
                     activity.latitude, activity.longitude
                 ), 2)
 
-            result.append({
-                'user_id': activity.user_id,
-                'email': activity.user.email,
-                'nick': activity.user.nick,
-                'distance_km': distance if distance is not None else -1,
-                'latitude': activity.latitude,
-                'longitude': activity.longitude,
-                'track_name': activity.track_name,
-                'artist_name': activity.artist_name,
-                'album_name': activity.album_name,
-                'last_updated': activity.last_updated.isoformat(),
-                'minutes_ago': int((datetime.datetime.utcnow() - activity.last_updated).total_seconds() / 60),
-                'instagram_username': activity.user.instagram_username,
-                'instagram_url': f'https://instagram.com/{activity.user.instagram_username}' if activity.user.instagram_username else None,
-                'avatar_url': f'/avatars/{activity.user.avatar_filename}' if activity.user.avatar_filename else None
-            })
+            result.append(_listener_info(activity, distance if distance is not None else -1, compact))
 
         result.sort(key=lambda x: x['distance_km'] if x['distance_km'] >= 0 else float('inf'))
 
-        return jsonify({
+        response = {
             'listeners': result,
             'total_count': len(result)
-        }), 200
+        }
+        if compact:
+            response['tracks'] = _track_dictionary(activities)
+        return jsonify(response), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/nearby-listeners', methods=['GET'])
+@api.route('/api/nearby-listeners', methods=['GET'])
 @token_required
 def get_nearby_listeners(current_user):
+    """
+    Słuchacze w promieniu max_distance, posortowani rosnąco po odległości.
+    ?max_distance=<km>&max_age_minutes=<int>&limit=<int>&cursor=<next_cursor>
+    Z limit zwracane jest tylko limit najbliższych; kolejną stronę pobiera się
+    z cursor=next_cursor z poprzedniej odpowiedzi.
+    ?track_dict=1 - utwory raz w słowniku 'tracks', u słuchaczy tylko track_id.
+    """
     try:
+        compact = request.args.get('track_dict') == '1'
         current_activity = UserActivity.query.filter_by(user_id=current_user.id).first()
         if not current_activity:
             return jsonify({'error': 'User location not found. Please update your activity first.'}), 400
         max_distance = request.args.get('max_distance', 50, type=float)
         max_age_minutes = request.args.get('max_age_minutes', 60, type=int)
+        limit = request.args.get('limit', type=int)
+        if limit is not None and not (1 <= limit <= MAX_NEARBY_LIMIT):
+            return jsonify({'error': f'limit must be between 1 and {MAX_NEARBY_LIMIT}'}), 400
+        cursor = request.args.get('cursor')
+        try:
+            after = _parse_nearby_cursor(cursor) if cursor else None
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
         cutoff_time = datetime.datetime.utcnow() - datetime.timedelta(minutes=max_age_minutes)
-        all_activities = UserActivity.query.join(User).filter(
-            UserActivity.user_id != current_user.id,
-            UserActivity.last_updated >= cutoff_time
-        ).all()
-        nearby_listeners = []
-        for activity in all_activities:
-            distance = calculate_distance(
-                current_activity.latitude, current_activity.longitude,
-                activity.latitude, activity.longitude
+        latitude, longitude = current_activity.latitude, current_activity.longitude
+        # o jeden więcej, żeby wiedzieć, czy istnieje następna strona
+        fetch = limit + 1 if limit is not None else None
+
+        # Etap 1: same (odległość, user_id) - bez budowania obiektów ORM
+        ranked = None
+        router = get_presence_router()
+        if router is not None:
+            # +1: wpis samego pytającego jest odfiltrowywany poniżej, a strona ma mieć `fetch` innych
+            hits = _presence_call(router.nearby, latitude, longitude, max_distance, _utc_timestamp(cutoff_time),
+                                  limit=fetch + 1 if fetch is not None else None, after=after)
+            if hits is not PRESENCE_UNAVAILABLE:
+                ranked = [(distance, user_id) for distance, user_id, _ in hits if user_id != current_user.id]
+        if ranked is None:
+            # bez partycji albo gdy są niedostępne - prefiltr bbox w bazie
+            min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, max_distance)
+            query = db.session.query(UserActivity.user_id, UserActivity.latitude, UserActivity.longitude).filter(
+                UserActivity.user_id != current_user.id,
+                UserActivity.last_updated >= cutoff_time,
+                UserActivity.latitude.between(min_lat, max_lat)
             )
-            if distance <= max_distance:
-                listener_data = {
-                    'user_id': activity.user_id,
-                    'email': activity.user.email,
-                    'nick': activity.user.nick,
-                    'distance_km': round(distance, 2),
-                    'latitude': activity.latitude,
-                    'longitude': activity.longitude,
-                    'track_name': activity.track_name,
-                    'artist_name': activity.artist_name,
-                    'album_name': activity.album_name,
-                    'last_updated': activity.last_updated.isoformat(),
-                    'minutes_ago': int((datetime.datetime.utcnow() - activity.last_updated).total_seconds() / 60),
-                    'instagram_username': activity.user.instagram_username,
-                    'instagram_url': f'https://instagram.com/{activity.user.instagram_username}' if activity.user.instagram_username else None,
-                    'avatar_url': f'/avatars/{activity.user.avatar_filename}' if activity.user.avatar_filename else None
-                }
-                nearby_listeners.append(listener_data)
-        nearby_listeners.sort(key=lambda x: x['distance_km'])
-        return jsonify({
+            if min_lon >= -180 and max_lon <= 180:
+                query = query.filter(UserActivity.longitude.between(min_lon, max_lon))
+            ranked = []
+            for user_id, lat, lon in query:
+                distance = calculate_distance(latitude, longitude, lat, lon)
+                if distance <= max_distance and (after is None or (distance, user_id) > after):
+                    ranked.append((distance, user_id))
+        ranked = heapq.nsmallest(fetch, ranked) if fetch is not None else sorted(ranked)
+        has_more = fetch is not None and len(ranked) > limit
+        page = ranked[:limit] if limit is not None else ranked
+
+        # Etap 2: pełne rekordy tylko dla wybranej strony
+        activities = {}
+        if page:
+            activities = {a.user_id: a for a in UserActivity.query.options(db.joinedload(UserActivity.user)).filter(
+                UserActivity.user_id.in_([user_id for _, user_id in page])
+            )}
+        nearby_listeners = [
+            _listener_info(activities[user_id], round(distance, 2), compact)
+            for distance, user_id in page if user_id in activities
+        ]
+        next_cursor = f'{page[-1][0]!r}:{page[-1][1]}' if has_more else None
+        metrics.nearby_result_size.observe(len(nearby_listeners))
+        response = {
             'listeners': nearby_listeners,
             'total_count': len(nearby_listeners),
+            'has_more': has_more,
+            'next_cursor': next_cursor,
             'search_params': {
                 'max_distance_km': max_distance,
                 'max_age_minutes': max_age_minutes,
+                'limit': limit,
                 'your_location': {
                     'latitude': current_activity.latitude,
                     'longitude': current_activity.longitude
                 }
             }
-        }), 200
+        }
+        if compact:
+            response['tracks'] = _track_dictionary(activities.values())
+        return jsonify(response), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@api.route('/api/trending-nearby', methods=['GET'])
+@token_required
+def get_trending_nearby(current_user):
+    """
+    Najpopularniejsze utwory i artyści w okolicy (przybliżone, patrz trending.py).
+    ?latitude=&longitude=&radius_km=<float>&window_minutes=<int>&limit=<int>
+    Bez współrzędnych używana jest ostatnia lokalizacja użytkownika.
+    """
+    index = get_trending_index()
+    if index is None:
+        return jsonify({'error': 'Trending is disabled with several workers unless HEARNEAR_TRENDING_MODE=remote'}), 503
+    try:
+        latitude = request.args.get('latitude', type=float)
+        longitude = request.args.get('longitude', type=float)
+        if latitude is None or longitude is None:
+            current_activity = UserActivity.query.filter_by(user_id=current_user.id).first()
+            if not current_activity:
+                return jsonify({'error': 'User location not found. Please update your activity first.'}), 400
+            latitude, longitude = current_activity.latitude, current_activity.longitude
+        if not (-90 <= latitude <= 90) or not (-180 <= longitude <= 180):
+            return jsonify({'error': 'Invalid coordinates'}), 400
+        radius_km = request.args.get('radius_km', 10, type=float)
+        if radius_km is None or not (0 < radius_km <= MAX_TRENDING_RADIUS_KM):
+            return jsonify({'error': f'radius_km must be between 0 and {MAX_TRENDING_RADIUS_KM}'}), 400
+        window_minutes = request.args.get('window_minutes', 60, type=int)
+        if window_minutes is None or not (1 <= window_minutes <= MAX_WINDOW_MINUTES):
+            return jsonify({'error': f'window_minutes must be between 1 and {MAX_WINDOW_MINUTES}'}), 400
+        limit = request.args.get('limit', 10, type=int)
+        if limit is None or not (1 <= limit <= MAX_TRENDING_LIMIT):
+            return jsonify({'error': f'limit must be between 1 and {MAX_TRENDING_LIMIT}'}), 400
+        result = _presence_call(index.top, latitude, longitude, radius_km, window_minutes=window_minutes, limit=limit)
+        if result is PRESENCE_UNAVAILABLE:
+            return jsonify({'error': 'Trending service is unavailable, retry later'}), 503
+        result['search_params'] = {
+            'latitude': latitude, 'longitude': longitude,
+            'radius_km': radius_km, 'window_minutes': window_minutes
+        }
+        return jsonify(result), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/my-activity', methods=['GET'])
+@api.route('/api/my-activity', methods=['GET'])
 @token_required
 def get_my_activity(current_user):
     try:
         activity = UserActivity.query.filter_by(user_id=current_user.id).first()
         if not activity:
             return jsonify({'message': 'No activity found'}), 404
+        last_updated = _last_seen(activity)
         return jsonify({
             'activity': {
                 'latitude': activity.latitude, 'longitude': activity.longitude,
                 'track_name': activity.track_name, 'artist_name': activity.artist_name,
                 'album_name': activity.album_name,
-                'last_updated': activity.last_updated.isoformat(),
-                'minutes_ago': int((datetime.datetime.utcnow() - activity.last_updated).total_seconds() / 60)
+                'last_updated': last_updated.isoformat(),
+                'minutes_ago': int((datetime.datetime.utcnow() - last_updated).total_seconds() / 60)
             }
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/delete-activity', methods=['DELETE'])
+@api.route('/api/delete-activity', methods=['DELETE'])
 @token_required
 def delete_activity(current_user):
     try:
@@ -528,12 +949,19 @@ def delete_activity(current_user):
             return jsonify({'message': 'No activity to delete'}), 404
         db.session.delete(activity)
         db.session.commit()
+        index = get_trending_index()
+        if index is not None:
+            _presence_call(index.forget_user, current_user.id)
+        liveness.forget(current_user.id)
+        router = get_presence_router()
+        if router is not None:
+            _presence_call(router.remove, current_user.id)
         return jsonify({'message': 'Activity deleted successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/cleanup-old-activities', methods=['POST'])
+@api.route('/api/cleanup-old-activities', methods=['POST'])
 def cleanup_old_activities():
     try:
         hours_old = request.json.get('hours_old', 24) if request.json else 24
@@ -543,6 +971,10 @@ def cleanup_old_activities():
         for activity in old_activities:
             db.session.delete(activity)
         db.session.commit()
+        liveness.forget_written_before(cutoff_time)
+        router = get_presence_router()
+        if router is not None:
+            _presence_call(router.expire, _utc_timestamp(cutoff_time))
         return jsonify({'message': f'Cleaned up {count} old activities', 'deleted_count': count}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -584,7 +1016,7 @@ def _friendship_status_for(current_user_id: int, other_user_id: int):
     return {'status': 'none', 'friendship_id': None}
 
 
-@app.route('/api/friends/request/<int:target_user_id>', methods=['POST'])
+@api.route('/api/friends/request/<int:target_user_id>', methods=['POST'])
 @token_required
 def send_friend_request(current_user, target_user_id):
     """Wysyła zaproszenie do znajomych."""
@@ -625,7 +1057,7 @@ def send_friend_request(current_user, target_user_id):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/friends/accept/<int:friendship_id>', methods=['POST'])
+@api.route('/api/friends/accept/<int:friendship_id>', methods=['POST'])
 @token_required
 def accept_friend_request(current_user, friendship_id):
     """Akceptuje zaproszenie (tylko adresat może akceptować)."""
@@ -648,7 +1080,7 @@ def accept_friend_request(current_user, friendship_id):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/friends/decline/<int:friendship_id>', methods=['POST'])
+@api.route('/api/friends/decline/<int:friendship_id>', methods=['POST'])
 @token_required
 def decline_friend_request(current_user, friendship_id):
     """Odrzuca zaproszenie (tylko adresat) lub usuwa ze znajomych (obie strony)."""
@@ -672,7 +1104,7 @@ def decline_friend_request(current_user, friendship_id):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/friends/remove/<int:target_user_id>', methods=['DELETE'])
+@api.route('/api/friends/remove/<int:target_user_id>', methods=['DELETE'])
 @token_required
 def remove_friend(current_user, target_user_id):
     """Usuwa znajomego (działa dla obu stron)."""
@@ -690,7 +1122,7 @@ def remove_friend(current_user, target_user_id):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/friends', methods=['GET'])
+@api.route('/api/friends', methods=['GET'])
 @token_required
 def get_friends(current_user):
     """Zwraca listę zaakceptowanych znajomych."""
@@ -717,7 +1149,7 @@ def get_friends(current_user):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/friends/pending', methods=['GET'])
+@api.route('/api/friends/pending', methods=['GET'])
 @token_required
 def get_pending_requests(current_user):
     """
@@ -762,7 +1194,7 @@ def get_pending_requests(current_user):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/friends/status/<int:target_user_id>', methods=['GET'])
+@api.route('/api/friends/status/<int:target_user_id>', methods=['GET'])
 @token_required
 def get_friendship_status(current_user, target_user_id):
     """Zwraca status relacji z konkretnym użytkownikiem."""
@@ -776,12 +1208,12 @@ def get_friendship_status(current_user, target_user_id):
 # ============================================================
 # --- HEALTH ---
 # ============================================================
-@app.route('/api/health', methods=['GET'])
+@api.route('/api/health', methods=['GET'])
 def health():
     return jsonify({'status': 'healthy'}), 200
 
 
-@app.route('/api/users/search', methods=['GET'])
+@api.route('/api/users/search', methods=['GET'])
 @token_required
 def search_users(current_user):
     """
@@ -815,7 +1247,117 @@ def search_users(current_user):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ============================================================
+# --- FABRYKA APLIKACJI ---
+# ============================================================
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(_config_from_env())
+    app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static', 'avatars')
+    if config:
+        app.config.update(config)
+
+    db.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app, metrics)
+    compression.init_app(app, metrics)
+    history.init_app(app, metrics)
+    # po kompresji: after_request admission widzi nieskompresowane ciało
+    admission.init_app(app, metrics, identify=_request_user_id)
+    liveness.min_move_meters = app.config['ACTIVITY_MIN_MOVE_METERS']
+    liveness.heartbeat_seconds = app.config['ACTIVITY_HEARTBEAT_SECONDS']
+    app.register_blueprint(api)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(presence_serve_command)
+    return app
+
+
+def init_db():
+    """
+    Tworzy brakujące tabele i indeksy (także indeksy dodane do istniejących tabel)
+    i migruje starą tabelę user_activity. Wszystko idzie jednym połączeniem;
+    przerwaną migrację (została user_activity_legacy) kolejne wywołanie dokańcza.
+    """
+    with db.engine.begin() as conn:
+        legacy_activity = _detach_legacy_activity_table(conn)
+        db.metadata.create_all(conn)
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        if legacy_activity:
+            _migrate_legacy_activities(conn)
+
+
+def _detach_legacy_activity_table(conn):
+    """
+    Stara tabela user_activity trzymała nazwy utworów w każdym wierszu.
+    Zmienia jej nazwę na user_activity_legacy (create_all utworzy nową);
+    zwraca True, jeśli migracja jest potrzebna - także gdy poprzednia
+    została przerwana po zmianie nazwy.
+    """
+    inspector = db.inspect(conn)
+    tables = inspector.get_table_names()
+    if 'user_activity_legacy' in tables:
+        return True
+    if 'user_activity' not in tables:
+        return False
+    if 'track_id' in {c['name'] for c in inspector.get_columns('user_activity')}:
+        return False
+    for index in inspector.get_indexes('user_activity'):
+        conn.execute(db.text(f'DROP INDEX IF EXISTS {index["name"]}'))
+    conn.execute(db.text('ALTER TABLE user_activity RENAME TO user_activity_legacy'))
+    return True
+
+
+def _migrate_legacy_activities(conn):
+    # warunki NOT EXISTS pomijają wiersze skopiowane przez przerwane wcześniej wywołanie
+    conn.execute(db.text(
+        "INSERT INTO track (track_name, artist_name, album_name) "
+        "SELECT DISTINCT track_name, artist_name, COALESCE(album_name, '') FROM user_activity_legacy "
+        "WHERE NOT EXISTS (SELECT 1 FROM track t WHERE t.track_name = user_activity_legacy.track_name "
+        "AND t.artist_name = user_activity_legacy.artist_name "
+        "AND t.album_name = COALESCE(user_activity_legacy.album_name, ''))"
+    ))
+    conn.execute(db.text(
+        "INSERT INTO user_activity (id, user_id, latitude, longitude, track_id, last_updated) "
+        "SELECT o.id, o.user_id, o.latitude, o.longitude, t.id, o.last_updated "
+        "FROM user_activity_legacy o JOIN track t ON t.track_name = o.track_name "
+        "AND t.artist_name = o.artist_name AND t.album_name = COALESCE(o.album_name, '') "
+        "WHERE NOT EXISTS (SELECT 1 FROM user_activity a WHERE a.id = o.id)"
+    ))
+    conn.execute(db.text('DROP TABLE user_activity_legacy'))
+
+
+@click.command('init-db')
+def init_db_command():
+    """Tworzy schemat bazy i indeksy."""
+    init_db()
+    click.echo('Database schema is up to date.')
+
+
+@click.command('presence-serve')
+@click.option('--processes', is_flag=True, help='Run each partition in its own process.')
+def presence_serve_command(processes):
+    """
+    Wspólny serwer dla workerów: partycje obecności (HEARNEAR_PRESENCE_MODE=remote,
+    gdy HEARNEAR_PRESENCE_PARTITIONS > 0) i indeks trending (HEARNEAR_TRENDING_MODE=remote).
+    """
+    config = current_app.config
+    partition_count = config['PRESENCE_PARTITIONS']
+    router = build_local_presence_router(partition_count, processes) if partition_count > 0 else None
+    server = PresenceServer(router, parse_address(config['PRESENCE_ADDRESS']), _presence_authkey(config),
+                            trending=TrendingIndex())
+    click.echo(f'Presence server with {partition_count} partitions and trending listening on {config["PRESENCE_ADDRESS"]}')
+    try:
+        server.serve_forever()
+    finally:
+        if router is not None:
+            router.bus.close()
+
+
 if __name__ == '__main__':
+    # serwer deweloperski to jeden proces - lokalne partycje i trending są tu poprawne
+    app = create_app({'SINGLE_WORKER': True})
     with app.app_context():
-        db.create_all()
+        init_db()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,131 @@
+"""
+Test wielowątkowy ConcurrencyLimiter (admission.py): udziały klas, przekazywanie
+slotów w kolejności priorytetu, limity kolejek i wyścig timeout / przydział.
+
+    python test_admission.py     (albo: python -m pytest test_admission.py)
+"""
+import random
+import threading
+import time
+
+from admission import ConcurrencyLimiter
+
+SHARES = {'critical': 1.0, 'normal': 0.5, 'low': 0.25}
+QUEUE_LIMITS = {'critical': 8, 'normal': 8, 'low': 8}
+
+
+def _waiter(limiter, priority, timeout, results):
+    def run():
+        results.append((priority, limiter.acquire(priority, timeout)))
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def _wait_queued(limiter, priority, count, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while len(limiter._queues[priority]) < count:
+        assert time.monotonic() < deadline, f'{priority} queue never reached {count}'
+        time.sleep(0.001)
+
+
+def test_class_shares():
+    limiter = ConcurrencyLimiter(4, SHARES, QUEUE_LIMITS)
+    assert limiter.class_limits == {'critical': 4, 'normal': 2, 'low': 1}
+    assert limiter.acquire('low', 0)
+    assert not limiter.acquire('low', 0.01)  # low: tylko 1 slot
+    assert limiter.acquire('normal', 0)
+    assert not limiter.acquire('normal', 0.01)  # normal: zajęte 2 z 4
+    assert limiter.acquire('critical', 0)
+    assert limiter.acquire('critical', 0)
+    assert limiter.in_flight == 4
+    for _ in range(4):
+        limiter.release()
+    assert limiter.in_flight == 0
+
+
+def test_release_prefers_higher_priority_fifo():
+    limiter = ConcurrencyLimiter(2, SHARES, QUEUE_LIMITS)
+    assert limiter.acquire('critical', 0)
+    assert limiter.acquire('critical', 0)
+    results = []
+    threads = [_waiter(limiter, 'normal', 2.0, results)]
+    _wait_queued(limiter, 'normal', 1)
+    threads.append(_waiter(limiter, 'critical', 2.0, results))
+    _wait_queued(limiter, 'critical', 1)
+
+    limiter.release()  # slot dla critical, mimo że normal czeka dłużej
+    threads[1].join(1.0)
+    assert results == [('critical', True)]
+    limiter.release()
+    limiter.release()  # in_flight = 0 < limit normal -> przydział dla normal
+    threads[0].join(1.0)
+    assert results[-1] == ('normal', True)
+    assert limiter.in_flight == 1
+
+
+def test_queued_normal_times_out_while_only_critical_slot_is_free():
+    limiter = ConcurrencyLimiter(2, SHARES, QUEUE_LIMITS)  # normal: 1 slot, critical: 2
+    assert limiter.acquire('critical', 0)
+    start = time.monotonic()
+    assert not limiter.acquire('normal', 0.05)
+    assert time.monotonic() - start >= 0.05
+    assert not limiter._queues['normal']  # waiter usunięty z kolejki
+    assert limiter.in_flight == 1  # odrzucenie nie zajęło slotu
+    assert limiter.acquire('critical', 0)  # wolny slot nadal dostępny dla critical
+    limiter.release()
+    limiter.release()
+    assert limiter.in_flight == 0
+
+
+def test_queue_limit_rejects_immediately():
+    limiter = ConcurrencyLimiter(1, SHARES, {'critical': 1, 'normal': 1, 'low': 1})
+    assert limiter.acquire('critical', 0)
+    results = []
+    thread = _waiter(limiter, 'critical', 1.0, results)
+    _wait_queued(limiter, 'critical', 1)
+    start = time.monotonic()
+    assert not limiter.acquire('critical', 1.0)  # kolejka pełna
+    assert time.monotonic() - start < 0.5
+    limiter.release()
+    thread.join(1.0)
+    assert results == [('critical', True)]
+    limiter.release()
+    assert limiter.in_flight == 0
+
+
+def test_no_slot_leaks_under_timeout_grant_races():
+    limiter = ConcurrencyLimiter(3, {'critical': 1.0, 'normal': 0.67, 'low': 0.34},
+                                 {'critical': 50, 'normal': 50, 'low': 50})
+    peak = [0]
+    admitted = [0]
+    lock = threading.Lock()
+
+    def client():
+        rng = random.Random()
+        for _ in range(50):
+            priority = rng.choice(('critical', 'normal', 'low'))
+            # timeouty rzędu czasu trzymania slotu - przydział często trafia na granicę timeoutu
+            if limiter.acquire(priority, rng.uniform(0, 0.003)):
+                with lock:
+                    admitted[0] += 1
+                    peak[0] = max(peak[0], limiter.in_flight)
+                time.sleep(rng.uniform(0, 0.002))
+                limiter.release()
+
+    threads = [threading.Thread(target=client) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert admitted[0] > 0
+    assert peak[0] <= 3
+    assert limiter.in_flight == 0
+    assert all(not queue for queue in limiter._queues.values())
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print(f'{name}: ok')
@@ -0,0 +1,126 @@
+"""
+Test migracji init_db(): stara tabela user_activity (nazwy utworów w każdym
+wierszu, schemat jak w dostarczonym instance/hearnear.db) -> katalog track.
+Sprawdza liczby wierszy po migracji i dokończenie migracji przerwanej po
+zmianie nazwy tabeli.
+
+    python test_migration.py     (albo: python -m pytest test_migration.py)
+"""
+import os
+import sqlite3
+import tempfile
+
+from python_auth_server import create_app, db, init_db
+
+LEGACY_SCHEMA = """
+CREATE TABLE user (
+    id INTEGER NOT NULL,
+    nick VARCHAR(50) NOT NULL,
+    email VARCHAR(100) NOT NULL,
+    password_hash VARCHAR(128) NOT NULL,
+    created_at DATETIME,
+    instagram_username VARCHAR(30),
+    avatar_filename VARCHAR(200),
+    PRIMARY KEY (id),
+    UNIQUE (nick),
+    UNIQUE (email),
+    UNIQUE (instagram_username)
+);
+CREATE TABLE user_activity (
+    id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    latitude FLOAT NOT NULL,
+    longitude FLOAT NOT NULL,
+    track_name VARCHAR(200) NOT NULL,
+    artist_name VARCHAR(200) NOT NULL,
+    album_name VARCHAR(200),
+    last_updated DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY(user_id) REFERENCES user (id)
+);
+"""
+
+# 9 aktywności, 8 różnych trójek (utwór, artysta, album) - NULL i '' to ten sam brak albumu
+ACTIVITIES = [
+    (1, 1, 'Song A', 'Artist 1', 'Album X'),
+    (2, 2, 'Song F', 'Artist 5', 'Album X'),
+    (3, 3, 'Song A', 'Artist 1', None),
+    (4, 4, 'Song A', 'Artist 1', ''),
+    (5, 5, 'Song A', 'Artist 2', 'Album X'),
+    (6, 6, 'Song B', 'Artist 1', 'Album X'),
+    (7, 1, 'Song C', 'Artist 3', None),
+    (8, 2, 'Song D', 'Artist 3', 'Album Y'),
+    (9, 3, 'Song E', 'Artist 4', 'Album Z'),
+]
+
+
+def _legacy_database(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany('INSERT INTO user (id, nick, email, password_hash) VALUES (?, ?, ?, ?)',
+                     [(i, f'user{i}', f'user{i}@example.com', 'x') for i in range(1, 7)])
+    conn.executemany(
+        'INSERT INTO user_activity (id, user_id, latitude, longitude, track_name, artist_name, album_name, '
+        "last_updated) VALUES (?, ?, 52.2, 21.0, ?, ?, ?, '2024-01-01 12:00:00')", ACTIVITIES)
+    conn.commit()
+    return conn
+
+
+def _migrate(path):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'})
+    with app.app_context():
+        init_db()
+        init_db()  # drugie wywołanie nie zmienia już zmigrowanej bazy
+        db.engine.dispose()
+
+
+def _check_migrated(path):
+    conn = sqlite3.connect(path)
+    tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert 'user_activity_legacy' not in tables
+    assert conn.execute('SELECT COUNT(*) FROM user_activity').fetchone() == (9,)
+    assert conn.execute('SELECT COUNT(*) FROM track').fetchone() == (8,)
+    migrated = conn.execute(
+        'SELECT a.id, a.user_id, t.track_name, t.artist_name, t.album_name '
+        'FROM user_activity a JOIN track t ON t.id = a.track_id ORDER BY a.id').fetchall()
+    assert migrated == [(i, u, track, artist, album or '') for i, u, track, artist, album in ACTIVITIES]
+    conn.close()
+
+
+def test_migrates_legacy_schema():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'hearnear.db')
+        _legacy_database(path).close()
+        _migrate(path)
+        _check_migrated(path)
+
+
+def test_resumes_interrupted_migration():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'hearnear.db')
+        conn = _legacy_database(path)
+        # stan po przerwanym przebiegu: nazwa zmieniona, nowe tabele z częścią danych
+        conn.executescript("""
+            ALTER TABLE user_activity RENAME TO user_activity_legacy;
+            CREATE TABLE track (
+                id INTEGER NOT NULL, track_name VARCHAR(200) NOT NULL, artist_name VARCHAR(200) NOT NULL,
+                album_name VARCHAR(200) NOT NULL, PRIMARY KEY (id),
+                CONSTRAINT uq_track UNIQUE (track_name, artist_name, album_name));
+            CREATE TABLE user_activity (
+                id INTEGER NOT NULL, user_id INTEGER NOT NULL, latitude FLOAT NOT NULL,
+                longitude FLOAT NOT NULL, track_id INTEGER NOT NULL, last_updated DATETIME, PRIMARY KEY (id),
+                FOREIGN KEY(user_id) REFERENCES user (id), FOREIGN KEY(track_id) REFERENCES track (id));
+            INSERT INTO track (id, track_name, artist_name, album_name) VALUES (1, 'Song A', 'Artist 1', 'Album X');
+            INSERT INTO user_activity (id, user_id, latitude, longitude, track_id, last_updated)
+                VALUES (1, 1, 52.2, 21.0, 1, '2024-01-01 12:00:00');
+        """)
+        conn.close()
+        _migrate(path)
+        _check_migrated(path)
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print(f'{name}: ok')
@@ -0,0 +1,144 @@
+"""
+Przybliżone "trending near me" utrzymywane przyrostowo.
+
+Każda zmiana utworu u użytkownika (update-activity) zwiększa liczniki
+w komórkach siatki geograficznej na kilku poziomach szczegółowości
+i w bieżącym kubełku czasowym. Liczniki to podsumowania Space-Saving
+(heavy hitters) o stałej pojemności, więc pamięć na komórkę jest ograniczona,
+a zapytanie scala co najwyżej MAX_QUERY_CELLS komórek niezależnie od
+liczby użytkowników (dla promieni większych niż najgrubszy poziom - bbox
+przycięty do świata, najwyżej ~170 komórek).
+"""
+import math
+import threading
+import time
+
+from geo import KM_PER_DEGREE, bounding_box
+
+# Rozmiary komórek w stopniach: ~2 km, ~9 km, ~36 km, ~142 km, ~570 km, ~2280 km
+LEVEL_CELL_DEGREES = (0.02, 0.08, 0.32, 1.28, 5.12, 20.48)
+MAX_QUERY_CELLS = 12
+# Najdłuższe okno zapytania (minuty)
+MAX_WINDOW_MINUTES = 180
+
+
+class SpaceSaving:
+    """Algorytm Space-Saving (Metwally i in.): top-k z gwarancją błędu <= N/capacity."""
+
+    __slots__ = ('capacity', 'counts')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, item, weight=1):
+        counts = self.counts
+        if item in counts:
+            counts[item] += weight
+        elif len(counts) < self.capacity:
+            counts[item] = weight
+        else:
+            victim = min(counts, key=counts.__getitem__)
+            counts[item] = counts.pop(victim) + weight
+
+
+def _merge_top(summaries, limit):
+    merged = {}
+    for summary in summaries:
+        for item, count in summary.counts.items():
+            merged[item] = merged.get(item, 0) + count
+    return sorted(merged.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+
+
+class _Bucket:
+    __slots__ = ('start', 'tracks', 'artists')
+
+    def __init__(self, start, capacity):
+        self.start = start
+        self.tracks = SpaceSaving(capacity)
+        self.artists = SpaceSaving(capacity)
+
+
+class TrendingIndex:
+    def __init__(self, bucket_seconds=300, max_window_minutes=MAX_WINDOW_MINUTES, capacity=32):
+        self.bucket_seconds = bucket_seconds
+        self.max_window_seconds = max_window_minutes * 60
+        self.capacity = capacity
+        self._cells = {}  # (poziom, wiersz, kolumna) -> lista _Bucket (rosnąco po czasie)
+        self._last_track = {}  # user_id -> (track_name, artist_name)
+        self._current_bucket = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cell(level, latitude, longitude):
+        size = LEVEL_CELL_DEGREES[level]
+        return level, math.floor(latitude / size), math.floor(longitude / size)
+
+    def record(self, user_id, latitude, longitude, track_name, artist_name, now=None):
+        """Rejestruje odtworzenie; powtórzone pushe tego samego utworu nie są liczone."""
+        track = (track_name, artist_name)
+        now = time.time() if now is None else now
+        bucket_start = int(now // self.bucket_seconds) * self.bucket_seconds
+        with self._lock:
+            if self._last_track.get(user_id) == track:
+                return False
+            self._last_track[user_id] = track
+            if bucket_start != self._current_bucket:
+                self._current_bucket = bucket_start
+                self._sweep(now)
+            for level in range(len(LEVEL_CELL_DEGREES)):
+                buckets = self._cells.setdefault(self._cell(level, latitude, longitude), [])
+                if not buckets or buckets[-1].start != bucket_start:
+                    self._expire(buckets, now)
+                    buckets.append(_Bucket(bucket_start, self.capacity))
+                bucket = buckets[-1]
+                bucket.tracks.add(track)
+                bucket.artists.add(artist_name)
+        return True
+
+    def forget_user(self, user_id):
+        with self._lock:
+            self._last_track.pop(user_id, None)
+
+    def _expire(self, buckets, now):
+        oldest = now - self.max_window_seconds - self.bucket_seconds
+        while buckets and buckets[0].start < oldest:
+            buckets.pop(0)
+
+    def _sweep(self, now):
+        for cell in list(self._cells):
+            buckets = self._cells[cell]
+            self._expire(buckets, now)
+            if not buckets:
+                del self._cells[cell]
+
+    def _query_cells(self, latitude, longitude, radius_km):
+        """Wybiera najdrobniejszy poziom, na którym bbox promienia mieści się w MAX_QUERY_CELLS komórkach."""
+        min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+        # przycięcie do świata - liczba komórek na najgrubszym poziomie jest ograniczona dla każdego promienia
+        min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+        min_lon, max_lon = max(min_lon, -180.0), min(max_lon, 180.0)
+        for level in range(len(LEVEL_CELL_DEGREES)):
+            _, y0, x0 = self._cell(level, min_lat, min_lon)
+            _, y1, x1 = self._cell(level, max_lat, max_lon)
+            if (y1 - y0 + 1) * (x1 - x0 + 1) <= MAX_QUERY_CELLS or level == len(LEVEL_CELL_DEGREES) - 1:
+                return level, [(level, y, x) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    def top(self, latitude, longitude, radius_km, window_minutes=60, limit=10, now=None):
+        now = time.time() if now is None else now
+        window_start = now - min(window_minutes * 60, self.max_window_seconds)
+        level, cells = self._query_cells(latitude, longitude, radius_km)
+        with self._lock:
+            buckets = [
+                b for cell in cells for b in self._cells.get(cell, ())
+                if b.start + self.bucket_seconds > window_start
+            ]
+            tracks = _merge_top((b.tracks for b in buckets), limit)
+            artists = _merge_top((b.artists for b in buckets), limit)
+        return {
+            'tracks': [
+                {'track_name': t, 'artist_name': a, 'plays': count} for (t, a), count in tracks
+            ],
+            'artists': [{'artist_name': a, 'plays': count} for a, count in artists],
+            'cell_size_km': round(LEVEL_CELL_DEGREES[level] * KM_PER_DEGREE, 1),
+        }
@@ -0,0 +1,17 @@
+"""
+Punkt wejścia dla serwera WSGI, np.:
+    gunicorn -w 4 wsgi:app
+
+Schematu bazy nie tworzy - przed pierwszym startem uruchom
+    flask --app python_auth_server init-db
+
+Z HEARNEAR_PRESENCE_PARTITIONS > 0 workery muszą korzystać ze wspólnego
+serwera partycji (HEARNEAR_PRESENCE_MODE=remote + `presence-serve`);
+lokalne partycje są dozwolone tylko z HEARNEAR_SINGLE_WORKER=1.
+Trending działa przy wielu workerach tylko z HEARNEAR_TRENDING_MODE=remote
+(ten sam `presence-serve`); inaczej /api/trending-nearby zwraca 503.
+"""
+from python_auth_server import check_presence_deployment, create_app
+
+app = create_app()
+check_presence_deployment(app.config)